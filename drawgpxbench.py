@@ -0,0 +1,924 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+"""Draw GPX bot stress tests and benchmarks
+
+Run it from the bot folder, drawgpxbot.cfg is read from there.
+
+Usage:
+./drawgpxbench.py stress [--chats N] [--points N]
+./drawgpxbench.py stats [--hours N]
+./drawgpxbench.py parse [--points N]
+./drawgpxbench.py output [--points N]
+./drawgpxbench.py bench [--points N,N,..] [--output FILE]
+./drawgpxbench.py compare OLD.json NEW.json
+./drawgpxbench.py loadtest [--uploads N] [--rate N]
+./drawgpxbench.py nik4-stub PATH
+"""
+
+import argparse
+import BaseHTTPServer
+import cgi
+import json
+import math
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import socket
+import SocketServer
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib2
+import urlparse
+from multiprocessing.pool import ThreadPool
+
+import dateutil.parser
+from dateutil import tz
+from geographiclib.geodesic import Geodesic
+
+import drawgpxbot
+
+
+# Synthetic tracks
+
+def make_gpx(num_points, lat=55.75, lon=37.62, start=1500000000,
+        interval=1, num_segments=1, seed=0, timestamps=True, elevation=True):
+    """ GPX 1.1 track, a ride at 0-10 m/s with turns and stops over hills,
+        elevation has GPS-like noise """
+    rnd = random.Random(seed)
+    out = ['<?xml version="1.0" encoding="UTF-8"?>\n',
+        '<!-- created by drawgpxbench -->\n',
+        '<?xml-stylesheet type="text/xsl" href="gpx.xsl"?>\n',
+        '<gpx version="1.1" creator="drawgpxbench"',
+        ' xmlns="http://www.topografix.com/GPX/1/1">\n<trk>\n']
+    seg_len = max(1, num_points // num_segments)
+    speed, heading = 5.0, rnd.uniform(0, 2 * math.pi)
+    ele, slope = 150.0, 0.0
+    for i in range(num_points):
+        if i % seg_len == 0:
+            if i > 0:
+                out.append('</trkseg>\n')
+            out.append('<trkseg>\n')
+        out.append('<trkpt lat="{0:.7f}" lon="{1:.7f}">'.format(lat, lon))
+        if elevation:
+            out.append('<ele>{0:.1f}</ele>'.format(ele + rnd.gauss(0, 1.5)))
+        if timestamps:
+            out.append('<time>{0}</time>'.format(time.strftime(
+                '%Y-%m-%dT%H:%M:%SZ', time.gmtime(start + i * interval))))
+        out.append('</trkpt>\n')
+        if rnd.random() < 0.005:
+            slope = rnd.uniform(-0.05, 0.05)
+        if rnd.random() < 0.002:
+            speed = 0.0
+        else:
+            speed = min(10.0, max(0.0, speed + rnd.gauss(0.05, 0.5)))
+        heading += rnd.gauss(0, 0.1)
+        step = speed * interval
+        ele = max(0.0, ele + slope * step)
+        lat += step * math.cos(heading) / 111320.0
+        lon += step * math.sin(heading) / (111320.0 * math.cos(math.radians(lat)))
+    out.append('</trkseg>\n</trk>\n</gpx>\n')
+    return ''.join(out)
+
+def make_gpx_file(num_points, **kwargs):
+    """ temporary file with synthetic track, removed on close """
+    f = tempfile.NamedTemporaryFile(suffix='.gpx')
+    f.write(make_gpx(num_points, **kwargs))
+    f.flush()
+    return f
+
+def make_track(num_points, **kwargs):
+    """ parsed synthetic track """
+    f = make_gpx_file(num_points, **kwargs)
+    track = drawgpxbot.read_track(f.name)
+    f.close()
+    return track
+
+def timeit(func, *args):
+    """ (best time of 3 runs, result) """
+    times = list()
+    for i in range(3):
+        started = time.time()
+        result = func(*args)
+        times.append(time.time() - started)
+    return min(times), result
+
+def percentile(values, p):
+    """ p-th percentile with linear interpolation """
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100.0
+    i = int(math.floor(k))
+    if i + 1 >= len(values):
+        return values[-1]
+    return values[i] + (values[i + 1] - values[i]) * (k - i)
+
+def peak_rss():
+    """ peak resident set size of the process and its children, KB """
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        + resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+def git_commit():
+    """ current commit of the bot, None outside git """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(drawgpxbot.__file__)),
+            stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Reference implementations
+
+def reference_parse_timestamp(text):
+    """ timestamp parsing as it was before parse_timestamp """
+    dt = dateutil.parser.parse(text).astimezone(tz.gettz('UTC'))
+    return int((dt - drawgpxbot.dt_zero).total_seconds())
+
+def reference_json(track):
+    """ GeoJSON as it was written before track outputs (all segments) """
+    features = list()
+    for first, end in track.get_segments():
+        features.append({"type": "Feature",
+            "properties": {"stroke": "#ff2b00", "stroke-width": 2, "stroke-opacity": 1},
+            "geometry": {"type": "LineString", "coordinates":
+                [[track.lon[i], track.lat[i]] for i in range(first, end)]}})
+    return json.dumps({"type": "FeatureCollection", "features": features},
+        indent=2)
+
+def reference_statistics(track):
+    """ statistics as they were computed before StatisticsEngine:
+        geodesic per pair, max speed over a fixed number of points """
+    min_movespeed = 0.3
+    lines = list()
+    for first, end in track.get_segments():
+        for i in range(first + 1, end):
+            dist = Geodesic.WGS84.Inverse(track.lat[i-1], track.lon[i-1],
+                track.lat[i], track.lon[i])['s12']
+            if track.time[i] == track.time[i-1]:
+                continue
+            lines.append([dist, track.time[i] - track.time[i-1]])
+    statistics = dict()
+    statistics['length'] = sum([l[0] for l in lines])
+    statistics['time'] = sum([l[1] for l in lines])
+    statistics['movetime'] = sum([l[1] for l in lines if l[0]/l[1]>min_movespeed])
+    statistics['movespeed'] = sum([l[0] for l in lines
+        if l[0]/l[1]>min_movespeed]) / statistics['movetime']
+    npnt = min(int(math.ceil(5.0 / lines[0][1])), len(lines))
+    maxspeed = 0.0
+    for i in range(npnt-1, len(lines)):
+        maxspeed = max([maxspeed,
+            sum([lines[j][0] for j in range(i-npnt+1, i+1)]) /
+            sum([lines[j][1] for j in range(i-npnt+1, i+1)])])
+    statistics['maxspeed'] = maxspeed
+    statistics['speed'] = statistics['length'] / statistics['time']
+    return statistics
+
+
+# Telegram stand-ins
+
+class FakeFile:
+    def __init__(self, path, latency=0.0):
+        self.__path = path
+        self.__latency = latency
+    def download(self, custom_path=None, out=None):
+        time.sleep(self.__latency)
+        if out is not None:
+            f = open(self.__path, 'rb')
+            out.write(f.read())
+            f.close()
+            return out
+        shutil.copy(self.__path, custom_path)
+        return custom_path
+
+class FakeDocument:
+    def __init__(self, path, file_id, latency=0.0):
+        self.__path = path
+        self.__latency = latency
+        self.file_id = file_id
+        self.file_unique_id = file_id
+        self.file_name = os.path.basename(path)
+        self.file_size = os.path.getsize(path)
+    def get_file(self):
+        return FakeFile(self.__path, self.__latency)
+
+class FakeSentDocument:
+    def __init__(self, file_id):
+        self.file_id = file_id
+
+class FakeMessage:
+    def __init__(self, file_id):
+        self.document = FakeSentDocument(file_id)
+
+class FakeBot:
+    """ records everything sent, by chat, documents take latency
+        seconds to upload """
+    def __init__(self, latency=0.0):
+        self.sent = dict()
+        self.__latency = latency
+        self.__cond = threading.Condition()
+    def __record(self, chat_id, kind, value):
+        with self.__cond:
+            self.sent.setdefault(chat_id, list()).append((kind, value))
+            self.__cond.notify_all()
+        return FakeMessage('sent-{0}-{1}'.format(chat_id, kind))
+    def send_document(self, chat_id, document, **kwargs):
+        if hasattr(document, 'read'):
+            document = document.read()
+        time.sleep(self.__latency)
+        return self.__record(chat_id, 'document', document)
+    def send_photo(self, chat_id, photo, **kwargs):
+        if hasattr(photo, 'read'):
+            photo = photo.read()
+        time.sleep(self.__latency)
+        return self.__record(chat_id, 'photo', photo)
+    def send_message(self, chat_id, text, **kwargs):
+        return self.__record(chat_id, 'message', text)
+    def send_location(self, chat_id, latitude, longitude, **kwargs):
+        return self.__record(chat_id, 'location', (latitude, longitude))
+    def wait(self, num, timeout):
+        """ wait for num messages in total """
+        deadline = time.time() + timeout
+        with self.__cond:
+            while (sum([len(v) for v in self.sent.values()]) < num
+                    and time.time() < deadline):
+                self.__cond.wait(1)
+
+NIK4_STUB = '''#!{0}
+import sys, shutil
+for arg in sys.argv:
+    if arg.startswith('track_geojson='):
+        shutil.copy(arg.split('=', 1)[1], sys.argv[-1])
+'''
+
+def write_nik4_stub(path):
+    """ nik4 replacement, 'renders' the track GeoJSON as the image """
+    f = open(path, 'w')
+    f.write(NIK4_STUB.format(sys.executable))
+    f.close()
+    os.chmod(path, 0o755)
+
+def install_nik4_stub(folder):
+    """ render with the nik4 replacement """
+    path = os.path.join(folder, 'nik4stub.py')
+    write_nik4_stub(path)
+    drawgpxbot.options['render_engine'] = 'nik4'
+    drawgpxbot.options['cmd_nik4'] = path
+
+
+# Bot API stand-in
+
+class FakeBotAPI(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """ Telegram Bot API server enough for the bot: updates by webhook or
+        getUpdates, getFile and file downloads, sendDocument, sendPhoto,
+        sendMessage, sendLocation. Everything sent is recorded by chat """
+    daemon_threads = True
+    allow_reuse_address = True
+    def __init__(self, address):
+        BaseHTTPServer.HTTPServer.__init__(self, address, FakeBotAPIHandler)
+        self.cond = threading.Condition()
+        self.files = dict()
+        self.updates = list()
+        self.webhook_url = None
+        self.polling = False
+        self.sent = dict()
+        self.next_id = 1
+    def handle_error(self, request, client_address):
+        # the bot gave up on a request (e.g. a long poll), nothing to report
+        if isinstance(sys.exc_info()[1], socket.error):
+            return
+        BaseHTTPServer.HTTPServer.handle_error(self, request, client_address)
+    def next_message_id(self):
+        with self.cond:
+            self.next_id += 1
+            return self.next_id
+    def ready(self):
+        """ the bot has set the webhook or is polling for updates """
+        with self.cond:
+            return self.webhook_url is not None or self.polling
+    def push_update(self, update):
+        """ send update to the webhook or queue it for getUpdates,
+            returns seconds the webhook took to accept it """
+        started = time.time()
+        if self.webhook_url is not None:
+            request = urllib2.Request(self.webhook_url, json.dumps(update),
+                {'Content-Type': 'application/json'})
+            urllib2.urlopen(request, timeout=30).read()
+        else:
+            with self.cond:
+                self.updates.append(update)
+                self.cond.notify_all()
+        return time.time() - started
+    def record(self, chat_id, method, value):
+        with self.cond:
+            self.sent.setdefault(int(chat_id), list()).append(
+                (time.time(), method, value))
+            self.cond.notify_all()
+    def get_updates(self, offset, timeout, limit):
+        deadline = time.time() + timeout
+        with self.cond:
+            if timeout > 0:
+                self.polling = True
+            self.updates = [u for u in self.updates if u['update_id'] >= offset]
+            while len(self.updates) == 0 and time.time() < deadline:
+                self.cond.wait(deadline - time.time())
+            return self.updates[:limit]
+
+class FakeBotAPIHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    def log_message(self, fmt, *args):
+        pass
+    def __reply(self, code, body, content_type='application/json'):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    def __params(self):
+        """ request parameters, files are (filename, data) """
+        if self.command == 'GET':
+            return dict((k, v[0]) for k, v in urlparse.parse_qs(
+                urlparse.urlsplit(self.path).query).items())
+        content_type = self.headers.get('Content-Type', '')
+        if content_type.startswith('multipart/form-data'):
+            form = cgi.FieldStorage(fp=self.rfile, headers=self.headers,
+                environ={'REQUEST_METHOD': 'POST',
+                    'CONTENT_TYPE': content_type})
+            params = dict()
+            for key in form.keys():
+                field = form[key]
+                if field.filename:
+                    params[key] = (field.filename, field.value)
+                else:
+                    params[key] = field.value
+            return params
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if content_type.startswith('application/json'):
+            return json.loads(body or '{}')
+        return dict((k, v[0]) for k, v in urlparse.parse_qs(body).items())
+    def __message(self, chat_id, **fields):
+        message = {'message_id': self.server.next_message_id(),
+            'date': int(time.time()),
+            'chat': {'id': int(chat_id), 'type': 'private'}}
+        message.update(fields)
+        return message
+    def do_GET(self):
+        parts = urlparse.urlsplit(self.path).path.split('/')
+        if len(parts) > 2 and parts[1] == 'file':
+            file_id = os.path.splitext(parts[-1])[0]
+            if file_id not in self.server.files:
+                self.__reply(404, 'no such file', 'text/plain')
+                return
+            self.__reply(200, self.server.files[file_id],
+                'application/octet-stream')
+            return
+        self.__api(parts[-1])
+    def do_POST(self):
+        self.__api(urlparse.urlsplit(self.path).path.split('/')[-1])
+    def __api(self, method):
+        params = self.__params()
+        server = self.server
+        if method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'Fake',
+                'username': 'fakebot'}
+        elif method == 'setWebhook':
+            with server.cond:
+                server.webhook_url = params.get('url') or None
+            result = True
+        elif method == 'deleteWebhook':
+            result = True
+        elif method == 'getUpdates':
+            result = server.get_updates(int(params.get('offset') or 0),
+                float(params.get('timeout') or 0),
+                int(params.get('limit') or 100))
+        elif method == 'getFile':
+            file_id = params['file_id']
+            result = {'file_id': file_id,
+                'file_size': len(server.files.get(file_id, '')),
+                'file_path': 'documents/{0}.gpx'.format(file_id)}
+        elif method == 'sendDocument':
+            document = params['document']
+            size = len(document[1]) if isinstance(document, tuple) else 0
+            server.record(params['chat_id'], 'document', size)
+            result = self.__message(params['chat_id'],
+                document={'file_id': 'sent{0}'.format(server.next_message_id()),
+                    'file_size': size})
+        elif method == 'sendPhoto':
+            photo = params['photo']
+            size = len(photo[1]) if isinstance(photo, tuple) else 0
+            server.record(params['chat_id'], 'photo', size)
+            result = self.__message(params['chat_id'],
+                photo=[{'file_id': 'sent{0}'.format(server.next_message_id()),
+                    'width': 600, 'height': 200, 'file_size': size}])
+        elif method == 'sendMessage':
+            server.record(params['chat_id'], 'message', params['text'])
+            result = self.__message(params['chat_id'], text=params['text'])
+        elif method == 'sendLocation':
+            location = {'latitude': float(params['latitude']),
+                'longitude': float(params['longitude'])}
+            server.record(params['chat_id'], 'location', location)
+            result = self.__message(params['chat_id'], location=location)
+        else:
+            result = True
+        self.__reply(200, json.dumps({'ok': True, 'result': result}))
+
+def make_update(update_id, chat_id, **fields):
+    message = {'message_id': update_id, 'date': int(time.time()),
+        'chat': {'id': chat_id, 'type': 'private'},
+        'from': {'id': chat_id, 'is_bot': False, 'first_name': 'Load',
+            'username': 'load{0}'.format(chat_id)}}
+    message.update(fields)
+    return {'update_id': update_id, 'message': message}
+
+
+# Commands
+
+def cmd_stress(args):
+    """ concurrent draw and stat jobs, every chat should get its own track """
+    tmp = tempfile.mkdtemp(prefix='drawgpxbench-')
+    try:
+        install_nik4_stub(tmp)
+        folder_work = os.path.join(tmp, 'work')
+        for folder in ('work', 'gpx', 'images'):
+            os.mkdir(os.path.join(tmp, folder))
+        drawgpxbot.workspaces = drawgpxbot.WorkspaceManager(folder_work,
+            args.workspace_mb * 1024 * 1024)
+        drawgpxbot.blob_cache = drawgpxbot.BlobCache(os.path.join(tmp, 'gpx'),
+            args.workspace_mb * 1024 * 1024)
+        drawgpxbot.render_cache = drawgpxbot.RenderCache(
+            os.path.join(tmp, 'images'), args.workspace_mb * 1024 * 1024, 3600)
+        drawgpxbot.pools['stat'] = multiprocessing.Pool(args.workers,
+            drawgpxbot.pool_worker_init)
+        drawgpxbot.pools['draw'] = multiprocessing.Pool(args.workers,
+            drawgpxbot.pool_worker_init)
+        bot = FakeBot(args.latency)
+        scheduler = drawgpxbot.JobScheduler(bot,
+            {'download': args.io_threads, 'stat': args.workers,
+             'draw': args.workers, 'upload': args.io_threads}, 2 * args.chats)
+        drawgpxbot.scheduler = scheduler
+        starts = dict()
+        for chat_id in range(args.chats):
+            # every chat has its own start point
+            starts[chat_id] = (50.0 + chat_id * 0.01, 30.0 + chat_id * 0.01)
+            path = os.path.join(tmp, 'chat{0}.gpx'.format(chat_id))
+            f = open(path, 'w')
+            f.write(make_gpx(args.points, lat=starts[chat_id][0],
+                lon=starts[chat_id][1]))
+            f.close()
+            document = FakeDocument(path, 'file{0}'.format(chat_id),
+                args.latency)
+            scheduler.put('download', drawgpxbot.job_gpx_draw, {'chat_id': chat_id,
+                'format': 'png', 'zoom': 12, 'color': 'red', 'width': 5,
+                'document': document})
+            scheduler.put('download', drawgpxbot.job_gpx_stat, {'chat_id': chat_id,
+                'document': document})
+        started = time.time()
+        # draw: document, stat: message and location
+        bot.wait(3 * args.chats, args.timeout)
+        elapsed = time.time() - started
+        failures = list()
+        for chat_id, start in starts.items():
+            sent = dict(bot.sent.get(chat_id, list()))
+            if 'document' not in sent:
+                failures.append('chat {0}: no image'.format(chat_id))
+            else:
+                coords = json.loads(sent['document'])['features'][0][
+                    'geometry']['coordinates']
+                if [round(c, 5) for c in coords[0][0]] != [start[1], start[0]]:
+                    failures.append('chat {0}: wrong image'.format(chat_id))
+            if sent.get('location') != start:
+                failures.append('chat {0}: wrong stats'.format(chat_id))
+        if len(os.listdir(folder_work)) > 0:
+            failures.append('workspaces left: {0}'.format(
+                os.listdir(folder_work)))
+        for failure in failures:
+            print(failure)
+        print('{0} chats, {1} jobs in {2:.2f} s, {3} failures'.format(
+            args.chats, 2 * args.chats, elapsed, len(failures)))
+        return 1 if len(failures) > 0 else 0
+    finally:
+        for pool in drawgpxbot.pools.values():
+            pool.terminate()
+        shutil.rmtree(tmp, ignore_errors=True)
+
+def cmd_stats(args):
+    """ statistics engine vs the reference implementation """
+    track = make_track(int(args.hours * 3600), num_segments=args.segments)
+    print('{0} points, {1} segments'.format(track.get_num_points(),
+        args.segments))
+    ref_time, ref = timeit(reference_statistics, track)
+    print('{0:<20} {1:8.3f} s'.format('reference', ref_time))
+    numpy = drawgpxbot.numpy
+    results = dict()
+    for use_numpy in (False, True):
+        if use_numpy and numpy is None:
+            print('numpy is not installed')
+            continue
+        drawgpxbot.numpy = numpy if use_numpy else None
+        for method in ('karney', 'fast'):
+            engine = drawgpxbot.StatisticsEngine(method)
+            eng_time, stats = timeit(engine.calc, track)
+            diff = max([abs(stats[k] - ref[k]) / ref[k] for k in ref])
+            print('{0:<20} {1:8.3f} s  x{2:<7.1f} max rel. diff {3:.1e}'.format(
+                method + ('/numpy' if use_numpy else '/python'),
+                eng_time, ref_time / eng_time, diff))
+            results[use_numpy] = stats
+        # the same without elevation, splits and histograms cost the rest
+        track.has_elevation = False
+        eng_time, stats = timeit(engine.calc, track)
+        track.has_elevation = True
+        print('{0:<20} {1:8.3f} s'.format(
+            method + ('/numpy' if use_numpy else '/python') + '/no ele', eng_time))
+    drawgpxbot.numpy = numpy
+    if len(results) < 2:
+        return 0
+    # numpy and python engines agree on the derived statistics
+    python, vectorized = results[False], results[True]
+    diff = max([abs(python[k] - vectorized[k]) for k in ('ascent', 'descent')] +
+        [abs(a - b) for k in ('splits', 'speedhist')
+            for a, b in zip(python[k], vectorized[k])] +
+        [abs(a - b) for a, b in zip(python['elehist'][1],
+            vectorized['elehist'][1])])
+    print('ascent {0:.0f} m, descent {1:.0f} m, {2} splits, python vs numpy '
+        'max diff {3:.1e}'.format(python['ascent'], python['descent'],
+        len(python['splits']), diff))
+    if (len(python['splits']) != len(vectorized['splits'])
+            or python['elehist'][0] != vectorized['elehist'][0] or diff > 1e-3):
+        print('python and numpy statistics differ')
+        return 1
+    return 0
+
+def cmd_parse(args):
+    """ gpx parsing with fast timestamps vs dateutil """
+    f = make_gpx_file(args.points)
+    print('{0} points, {1} bytes'.format(args.points, os.path.getsize(f.name)))
+    fast_parse_timestamp = drawgpxbot.parse_timestamp
+    results = dict()
+    for name, func in (('dateutil', reference_parse_timestamp),
+            ('fast', fast_parse_timestamp)):
+        drawgpxbot.parse_timestamp = func
+        elapsed, track = timeit(drawgpxbot.read_track, f.name)
+        results[name] = track
+        print('{0:<10} {1:8.3f} s {2:10.0f} points/s'.format(name, elapsed,
+            args.points / elapsed))
+    drawgpxbot.parse_timestamp = fast_parse_timestamp
+    f.close()
+    if results['fast'].time != results['dateutil'].time:
+        print('timestamps differ')
+        return 1
+    return 0
+
+def cmd_output(args):
+    """ size and time of track outputs for the renderer """
+    track = make_track(args.points, num_segments=args.segments)
+    for zoom in (None, 12):
+        if zoom is None:
+            print('{0} points'.format(track.get_num_points()))
+        else:
+            track = track.simplified(zoom, 0.5, 'dp')
+            print('simplified for zoom {0}: {1} points'.format(zoom,
+                track.get_num_points()))
+        for name, func in (('indented json', reference_json),
+                ('compact json', track.get_json),
+                ('wkb', track.get_wkb)):
+            if name == 'indented json':
+                elapsed, data = timeit(func, track)
+            else:
+                elapsed, data = timeit(func)
+            print('  {0:<14} {1:8.3f} s {2:10d} bytes'.format(name, elapsed,
+                len(data)))
+    return 0
+
+BENCH_STAGES = ('parse', 'stats', 'simplify', 'geojson', 'render')
+
+def bench_stage(runs, points, func, *args):
+    """ timings of runs calls, returns (summary, last result) """
+    times = list()
+    for i in range(runs):
+        started = time.time()
+        result = func(*args)
+        times.append(time.time() - started)
+    median = percentile(times, 50)
+    return {
+        'runs': runs,
+        'min': min(times),
+        'mean': sum(times) / len(times),
+        'p50': median,
+        'p90': percentile(times, 90),
+        'p99': percentile(times, 99),
+        'max': max(times),
+        'points_per_s': points / median if median > 0 else None,
+        'peak_rss_kb': peak_rss()
+    }, result
+
+def cmd_bench(args):
+    """ parse, stats, simplify, geojson and render timings on synthetic
+        tracks, results are saved as JSON for compare """
+    tmp = tempfile.mkdtemp(prefix='drawgpxbench-')
+    try:
+        engine = drawgpxbot.options.get('render_engine', 'mapnik')
+        if args.stub_nik4 or (drawgpxbot.mapnik is None and engine != 'nik4'):
+            install_nik4_stub(tmp)
+            engine = 'nik4 stub'
+        results = dict()
+        for num_points in [int(n) for n in args.points.split(',')]:
+            case = '{0}p-{1}s-{2}seg{3}'.format(num_points, args.interval,
+                args.segments, '' if args.timestamps else '-notime')
+            path = os.path.join(tmp, 'track.gpx')
+            f = open(path, 'w')
+            f.write(make_gpx(num_points, interval=args.interval,
+                num_segments=args.segments, timestamps=args.timestamps))
+            f.close()
+            stages = dict()
+            stages['parse'], track = bench_stage(args.runs, num_points,
+                drawgpxbot.read_track, path)
+            stages['stats'], stats = bench_stage(args.runs, num_points,
+                drawgpxbot.gpx_stat, track)
+            stages['simplify'], simple_track = bench_stage(args.runs,
+                num_points, track.simplified, args.zoom,
+                float(drawgpxbot.options.get('simplify_pixels', 0.5)),
+                drawgpxbot.options.get('simplify_algorithm', 'dp'))
+            stages['geojson'], output = bench_stage(args.runs,
+                simple_track.get_num_points(), drawgpxbot.GeoJSONTrackOutput,
+                [simple_track], ['red'], tmp)
+            if args.render:
+                stages['render'], (image, tiles) = bench_stage(args.runs, num_points,
+                    drawgpxbot.gpx_draw, [track], tmp, 'png', args.zoom,
+                    ['red'], 5)
+            results[case] = {
+                'points': num_points,
+                'simplified_points': simple_track.get_num_points(),
+                'gpx_bytes': os.path.getsize(path),
+                'stages': stages
+            }
+            print(case)
+            for name in BENCH_STAGES:
+                if name not in stages:
+                    continue
+                st = stages[name]
+                print('  {0:<9} p50 {1:8.4f} s  p90 {2:8.4f} s  p99 {3:8.4f} s'
+                    '  {4:10.0f} points/s  rss {5:7.1f} MB'.format(name,
+                    st['p50'], st['p90'], st['p99'], st['points_per_s'] or 0,
+                    st['peak_rss_kb'] / 1024.0))
+        report = {
+            'commit': git_commit(),
+            'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'numpy': drawgpxbot.numpy is not None,
+            'render_engine': engine,
+            'options': {
+                'stats_distance': drawgpxbot.options.get('stats_distance', 'fast'),
+                'simplify_algorithm': drawgpxbot.options.get('simplify_algorithm', 'dp'),
+                'simplify_pixels': drawgpxbot.options.get('simplify_pixels', 0.5),
+                'track_output': drawgpxbot.options.get('track_output', 'geojson')
+            },
+            'results': results
+        }
+        if args.output is not None:
+            f = open(args.output, 'w')
+            json.dump(report, f, indent=2, sort_keys=True)
+            f.close()
+            print('results saved to {0}'.format(args.output))
+        return 0
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+def cmd_compare(args):
+    """ median times of two bench results, exits with 1 if anything got
+        slower than the threshold """
+    reports = list()
+    for path in (args.old, args.new):
+        f = open(path)
+        reports.append(json.load(f))
+        f.close()
+    old, new = reports
+    print('{0} -> {1}'.format(old.get('commit') or args.old,
+        new.get('commit') or args.new))
+    regressions = 0
+    for case in sorted(set(old['results']) & set(new['results'])):
+        print(case)
+        old_stages = old['results'][case]['stages']
+        new_stages = new['results'][case]['stages']
+        for name in BENCH_STAGES:
+            if name not in old_stages or name not in new_stages:
+                continue
+            before = old_stages[name]['p50']
+            after = new_stages[name]['p50']
+            ratio = after / before if before > 0 else float('inf')
+            mark = ''
+            if abs(after - before) < args.min_diff / 1000.0:
+                pass
+            elif ratio > 1.0 + args.threshold / 100.0:
+                mark = '  SLOWER'
+                regressions += 1
+            elif ratio < 1.0 - args.threshold / 100.0:
+                mark = '  faster'
+            print('  {0:<9} {1:8.4f} s -> {2:8.4f} s  x{3:.2f}{4}'.format(
+                name, before, after, ratio, mark))
+    for name in sorted(set(old['results']) ^ set(new['results'])):
+        print('{0}: in one of the results only'.format(name))
+    return 1 if regressions > 0 else 0
+
+def send_upload(api, chat_id, file_id, file_size):
+    """ GPX document and /gpxdraw from the chat, returns seconds
+        the updates took to be accepted """
+    document = make_update(2 * chat_id, chat_id,
+        document={'file_id': file_id, 'file_name': file_id + '.gpx',
+            'mime_type': 'application/gpx+xml', 'file_size': file_size})
+    command = make_update(2 * chat_id + 1, chat_id, text='/gpxdraw',
+        entities=[{'type': 'bot_command', 'offset': 0, 'length': 8}])
+    return [api.push_update(document), api.push_update(command)]
+
+def upload_outcome(sent):
+    """ delivered, refused, limited (over the chat budget), failed or None
+        if there is no answer yet """
+    for tm, method, value in sent:
+        if method == 'document':
+            return 'delivered'
+        if method != 'message':
+            continue
+        if value.startswith(u'Слишком много дел'):
+            return 'refused'
+        if value.startswith(u'Ты уже много всего'):
+            return 'limited'
+        if value.startswith(u'Ничего не вышло') or value.startswith(u'Ерунда'):
+            return 'failed'
+    return None
+
+def cmd_loadtest(args):
+    """ stand-in Bot API for the bot and a load of GPX uploads with /gpxdraw,
+        measures time from the upload to the image """
+    api = FakeBotAPI(('127.0.0.1', args.port))
+    th = threading.Thread(target=api.serve_forever, name='fake-api')
+    th.daemon = True
+    th.start()
+    print('point the bot at the stand-in API (drawgpxbot.cfg):')
+    print('api_url = http://127.0.0.1:{0}/bot'.format(args.port))
+    print('api_file_url = http://127.0.0.1:{0}/file/bot'.format(args.port))
+    deadline = time.time() + args.wait
+    while not api.ready():
+        if time.time() > deadline:
+            print('the bot has not shown up in {0} s'.format(args.wait))
+            return 1
+        time.sleep(0.2)
+    mode = 'webhook' if api.webhook_url is not None else 'polling'
+    print('bot is here ({0}), {1} uploads at {2}/s'.format(mode,
+        args.uploads, args.rate))
+    tracks = [make_gpx(args.points, lat=50.0 + i * 0.001, seed=i)
+        for i in range(args.tracks or args.uploads)]
+    senders = ThreadPool(args.senders)
+    uploaded = dict()
+    accepted = list()
+    started = time.time()
+    for i in range(args.uploads):
+        delay = started + i / args.rate - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        chat_id = 1000 + i
+        file_id = 'gpx{0}'.format(i)
+        api.files[file_id] = tracks[i % len(tracks)]
+        uploaded[chat_id] = time.time()
+        accepted.append(senders.apply_async(send_upload,
+            (api, chat_id, file_id, len(api.files[file_id]))))
+    send_time = time.time() - started
+    accept_times = list()
+    for result in accepted:
+        accept_times += result.get()
+    senders.close()
+    deadline = time.time() + args.timeout
+    with api.cond:
+        while time.time() < deadline:
+            if all(upload_outcome(api.sent.get(chat_id, ())) is not None
+                    for chat_id in uploaded):
+                break
+            api.cond.wait(1)
+        sent = dict((chat_id, list(api.sent.get(chat_id, ())))
+            for chat_id in uploaded)
+    api.shutdown()
+    outcomes = dict()
+    latencies = list()
+    for chat_id, chat_sent in sent.items():
+        outcome = upload_outcome(chat_sent) or 'missing'
+        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+        if outcome == 'delivered':
+            delivered = min(tm for tm, method, value in chat_sent
+                if method == 'document')
+            latencies.append(delivered - uploaded[chat_id])
+    report = {
+        'commit': git_commit(),
+        'mode': mode,
+        'uploads': args.uploads,
+        'points': args.points,
+        'rate': args.rate,
+        'sent_rate': args.uploads / send_time if send_time > 0 else None,
+        'outcomes': outcomes,
+        'accept_p50': percentile(accept_times, 50),
+        'accept_p99': percentile(accept_times, 99)
+    }
+    if len(latencies) > 0:
+        report['throughput'] = len(latencies) / (max(
+            [t for chat_sent in sent.values() for t, m, v in chat_sent]) - started)
+        for p in (50, 90, 99):
+            report['latency_p{0}'.format(p)] = percentile(latencies, p)
+        report['latency_max'] = max(latencies)
+    print('{0} uploads sent at {1:.1f}/s, updates accepted in {2:.4f} s'
+        ' (p50), {3:.4f} s (p99)'.format(args.uploads, report['sent_rate'],
+        report['accept_p50'], report['accept_p99']))
+    print(', '.join('{0} {1}'.format(n, outcome)
+        for outcome, n in sorted(outcomes.items())))
+    if len(latencies) > 0:
+        print('upload to image: p50 {0:.3f} s, p90 {1:.3f} s, p99 {2:.3f} s,'
+            ' max {3:.3f} s, {4:.1f} images/s'.format(report['latency_p50'],
+            report['latency_p90'], report['latency_p99'],
+            report['latency_max'], report['throughput']))
+    if args.output is not None:
+        f = open(args.output, 'w')
+        json.dump(report, f, indent=2, sort_keys=True)
+        f.close()
+        print('results saved to {0}'.format(args.output))
+    return 0 if outcomes.get('missing', 0) == 0 else 1
+
+def cmd_nik4_stub(args):
+    """ write the Nik4 stand-in for cmd_nik4 of a bot without Mapnik """
+    write_nik4_stub(args.path)
+    print('cmd_nik4 = {0}'.format(os.path.abspath(args.path)))
+    return 0
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    commands = parser.add_subparsers()
+    stress = commands.add_parser('stress', help=cmd_stress.__doc__)
+    stress.add_argument('--chats', type=int, default=50)
+    stress.add_argument('--points', type=int, default=1000)
+    stress.add_argument('--workers', type=int, default=4)
+    stress.add_argument('--workspace-mb', type=int, default=64)
+    stress.add_argument('--latency', type=float, default=0.0,
+        help='seconds every download and upload takes')
+    stress.add_argument('--io-threads', type=int, default=4,
+        help='download and upload threads')
+    stress.add_argument('--timeout', type=int, default=300)
+    stress.set_defaults(func=cmd_stress)
+    stats = commands.add_parser('stats', help=cmd_stats.__doc__)
+    stats.add_argument('--hours', type=float, default=4)
+    stats.add_argument('--segments', type=int, default=1)
+    stats.set_defaults(func=cmd_stats)
+    parse = commands.add_parser('parse', help=cmd_parse.__doc__)
+    parse.add_argument('--points', type=int, default=50000)
+    parse.set_defaults(func=cmd_parse)
+    output = commands.add_parser('output', help=cmd_output.__doc__)
+    output.add_argument('--points', type=int, default=100000)
+    output.add_argument('--segments', type=int, default=3)
+    output.set_defaults(func=cmd_output)
+    bench = commands.add_parser('bench', help=cmd_bench.__doc__)
+    bench.add_argument('--points', default='1000,10000,100000',
+        help='comma separated track lengths')
+    bench.add_argument('--interval', type=int, default=1,
+        help='seconds between points')
+    bench.add_argument('--segments', type=int, default=1)
+    bench.add_argument('--no-timestamps', dest='timestamps',
+        action='store_false')
+    bench.add_argument('--zoom', type=int, default=12)
+    bench.add_argument('--runs', type=int, default=10)
+    bench.add_argument('--no-render', dest='render', action='store_false')
+    bench.add_argument('--stub-nik4', action='store_true',
+        help='render with the Nik4 stand-in (used anyway without Mapnik)')
+    bench.add_argument('--output', help='save results to this JSON file')
+    bench.set_defaults(func=cmd_bench)
+    compare = commands.add_parser('compare', help=cmd_compare.__doc__)
+    compare.add_argument('old')
+    compare.add_argument('new')
+    compare.add_argument('--threshold', type=float, default=10,
+        help='percent of median time change to report')
+    compare.add_argument('--min-diff', type=float, default=1,
+        help='milliseconds, smaller changes are noise')
+    compare.set_defaults(func=cmd_compare)
+    loadtest = commands.add_parser('loadtest', help=cmd_loadtest.__doc__)
+    loadtest.add_argument('--port', type=int, default=8081)
+    loadtest.add_argument('--uploads', type=int, default=1000)
+    loadtest.add_argument('--rate', type=float, default=100,
+        help='uploads per second')
+    loadtest.add_argument('--points', type=int, default=1000)
+    loadtest.add_argument('--tracks', type=int,
+        help='different tracks (default: every upload is a new one)')
+    loadtest.add_argument('--senders', type=int, default=8,
+        help='threads sending updates')
+    loadtest.add_argument('--wait', type=int, default=120,
+        help='seconds to wait for the bot to connect')
+    loadtest.add_argument('--timeout', type=int, default=600)
+    loadtest.add_argument('--output', help='save results to this JSON file')
+    loadtest.set_defaults(func=cmd_loadtest)
+    nik4_stub = commands.add_parser('nik4-stub', help=cmd_nik4_stub.__doc__)
+    nik4_stub.add_argument('path')
+    nik4_stub.set_defaults(func=cmd_nik4_stub)
+    args = parser.parse_args()
+    sys.exit(args.func(args))
+
+if __name__ == '__main__':
+    main()
@@ -15,7 +15,9 @@ __author__ = "https://github.com/cheshire-mouse"
 __license__ = "WTFPL v. 2"
 __version__ = "0.1"
 
-from telegram import TelegramError
+import telegram
+from telegram import Bot, TelegramError
+from telegram.utils.request import Request
 from telegram.ext import Updater, CommandHandler, MessageHandler
 from telegram.ext.filters import Filters
 import logging
@@ -30,12 +32,53 @@ import dateutil.parser
 from dateutil import tz
 from geographiclib.geodesic import Geodesic
 import math
+import calendar
+import heapq
+import bisect
+import struct
+import zlib
+import sys
 import argparse
+from array import array
+import threading
+import io
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import signal
+import tempfile
+import shutil
+import hashlib
+import time
+import random
+import cProfile
+import BaseHTTPServer
+import sqlite3
+import uuid
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+try:
+    import mapnik
+except ImportError:
+    mapnik = None
+try:
+    import cairo
+except ImportError:
+    cairo = None
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 # Read config
 config = ConfigParser.RawConfigParser()
 config.read('drawgpxbot.cfg')
 options = dict(config.items('general'))
+
+def option_flag(name, default=False):
+    """ boolean option """
+    if name not in options:
+        return default
+    return options[name].lower() in ('1', 'yes', 'true', 'on')
  
 # Enable logging
 logging.basicConfig(filename=options['file_log'],
@@ -59,296 +102,2408 @@ class ArgumentParseError(Exception):
     def __init__(self, message):
         self.message = message
 
+class SchedulerFullException(Exception):
+    """ Too many jobs are waiting already """
+    def __init__(self, message):
+        self.message = message
+
+class DuplicateJobException(Exception):
+    """ The same job is waiting already """
+    def __init__(self, message):
+        self.message = message
+
+class WorkspaceFullException(Exception):
+    """ Job needs more scratch space than allowed """
+    def __init__(self, message):
+        self.message = message
+
+class GPXTooBigException(Exception):
+    """ GPX file is over the size limits """
+    def __init__(self, message):
+        self.message = message
+
+class GPXRenderFailureException(Exception):
+    """ Can't render the map """
+    def __init__(self, message):
+        self.message = message
+
+class RenderBudgetException(Exception):
+    """ Image would take too long to render, zoom fits the budget """
+    def __init__(self, message, zoom):
+        self.message = message
+        self.zoom = zoom
+
+class RateLimitException(Exception):
+    """ Chat asked for more work than its budget, wait is seconds
+        until the job would fit """
+    def __init__(self, message, wait):
+        self.message = message
+        self.wait = wait
+
+class OverloadException(Exception):
+    """ The bot has more work queued than it can do in time """
+    def __init__(self, message):
+        self.message = message
+
 class SilentArgumentParser(argparse.ArgumentParser):
     """ Argument Parser, no message printing, only exceptions """
     def error(self, message):
         raise ArgumentParseError(('Argument parsing error: %s\n') % (message))
 
-class Gpx2JSONTarget:
-    """ XML handler """
-    __xmlns = "{http://www.topografix.com/GPX/1/1}"
-    __dt_zero = datetime(1970,1,1,tzinfo=tz.gettz('UTC'))
-    __min_movespeed = 0.3 # ~1km/h
-    def __init__(self):
-        logger.info('read gpx XML')
-        self.__bbox = {'xmin':1000, 'ymin':1000, 'xmax':-1000, 'ymax':-1000 }
-        self.__num_points = 0
-        self.__track = list()
-        self.__has_timestamps = True
-        self.__last_tag = None
-        self.__reading_segment = False
-        return
-    def start(self, tag, attrib):
-        if (tag == self.__xmlns + "trk"): 
-            logger.debug('track start')
-        elif (tag == self.__xmlns + "trkseg"): 
-            logger.debug('track segment start')
-            self.__track.append(list())
-            self.__reading_segment = True
-        elif (tag == self.__xmlns + "trkpt"):
-            if ( self.__has_timestamps 
-                    and len(self.__track[-1]) > 0 
-                    and len(self.__track[-1][-1]) < 3 ):
-                self.__has_timestamps = False
-            lon = float(attrib["lon"])
-            lat = float(attrib["lat"])
-            self.__bbox['xmin'] = min(self.__bbox['xmin'],lon)
-            self.__bbox['xmax'] = max(self.__bbox['xmax'],lon)
-            self.__bbox['ymin'] = min(self.__bbox['ymin'],lat)
-            self.__bbox['ymax'] = max(self.__bbox['ymax'],lat)
-            self.__track[-1].append({'lon':lon,'lat':lat})
-            self.__num_points += 1
-        self.__last_tag = tag
-    def end(self, tag):
-        if (tag == self.__xmlns + "trk"): 
-            logger.debug('track end')
-        elif (tag == self.__xmlns + "trkseg"): 
-            logger.debug('track segment end')
-            self.__reading_segment = False
-        self.__last_tag = None
-        return
-    def data(self, data):
-        if (self.__last_tag == self.__xmlns + "time"
-                and self.__reading_segment):
-            #dt.utcfromtimestamp(int((dateutil.parser.parse('2018-07-07T11:47:47Z').astimezone(tz.gettz('UTC')) - dt(1970,1,1,tzinfo=tz.gettz('UTC')) ).total_seconds()))
-            dt = dateutil.parser.parse(data).astimezone(tz.gettz('UTC'))
-            timestamp = int((dt - self.__dt_zero).total_seconds())
-            self.__track[-1][-1]['timestamp'] = timestamp
-        return
-#    def comment(self, text):
-#        return
-    def close(self):
-        logger.debug('gpx has timestamps: {}'.format(self.__has_timestamps))
-        logger.info("end of the gpx XML,"+
-                " {0} points found".format(self.__num_points))
-        return 
-    def calc_statistics(self):
+timestamp_re = re.compile(r'^\s*(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)(\.\d+)?'
+    r'(?:(Z)|([+-])(\d\d):?(\d\d))\s*$')
+dt_zero = datetime(1970,1,1,tzinfo=tz.tzutc())
+
+def parse_timestamp(text):
+    """ seconds since epoch, YYYY-MM-DDTHH:MM:SS[.fff](Z|+HH:MM) is parsed
+        here, everything else with dateutil (time without zone is UTC) """
+    m = timestamp_re.match(text)
+    if m is None:
+        dt = dateutil.parser.parse(text)
+        if dt.tzinfo is None:
+            dt = dt.replace(tzinfo=tz.tzutc())
+        return (dt - dt_zero).total_seconds()
+    year, month, day, hour, minute, sec, frac, utc, sign, off_h, off_m = m.groups()
+    timestamp = calendar.timegm((int(year), int(month), int(day),
+        int(hour), int(minute), int(sec)))
+    if frac is not None:
+        timestamp += float(frac)
+    if utc is None:
+        offset = int(off_h) * 3600 + int(off_m) * 60
+        timestamp += -offset if sign == '+' else offset
+    return timestamp
+
+class StatisticsEngine:
+    """ Track statistics computed for all points at once (with numpy if
+        there is one).
+        Distances: 'karney' - geodesic (geographiclib), 'fast' - ellipsoid
+        approximation by local radii of curvature, for points less than
+        1 km apart it is within 1e-6 of geodesic distance.
+        Max speed is the best speed over at least max_speed_window seconds,
+        window is selected by time, not by number of points.
+        Ascent and descent count only ups and downs of elevation_threshold
+        or more (GPS elevation noise is several meters). Splits are times
+        of every full split_length, speed histogram is time in speed_bins
+        (km/h, the last one is open), elevation histogram is distance in
+        elevation bands. Everything is computed in one pass over the pairs
+        of neighbour points """
+    __a = 6378137.0
+    __f = 1 / 298.257223563
+    __e2 = __f * (2 - __f)
+    min_movespeed = 0.3 # ~1km/h
+    max_speed_window = 5.0
+    elevation_threshold = 5.0
+    split_length = 1000.0
+    speed_bins = (0, 5, 10, 15, 20, 25, 30, 40, 50)
+    profile_points = 600
+    def __init__(self, method='fast'):
+        if method not in ('karney', 'fast'):
+            raise ValueError('unknown distance method {0}'.format(method))
+        self.__method = method
+    def __pair_mask(self, track):
+        """ True for pairs of neighbour points of the same segment """
+        mask = numpy.ones(max(0, track.get_num_points() - 1), dtype=bool)
+        for first in track.segments[1:]:
+            # empty segments at the end start after the last point
+            if 0 < first <= len(mask):
+                mask[first - 1] = False
+        return mask
+    def __distances_numpy(self, lon, lat):
+        if self.__method == 'karney':
+            inverse = Geodesic.WGS84.Inverse
+            return numpy.array([inverse(lat[i-1],lon[i-1],lat[i],lon[i],
+                Geodesic.DISTANCE)['s12'] for i in range(1, len(lon))])
+        lon = numpy.radians(lon)
+        lat = numpy.radians(lat)
+        lat_mid = (lat[1:] + lat[:-1]) / 2
+        w2 = 1 - self.__e2 * numpy.sin(lat_mid) ** 2
+        # meridional and prime vertical radii of curvature
+        m = self.__a * (1 - self.__e2) / (w2 * numpy.sqrt(w2))
+        n = self.__a / numpy.sqrt(w2)
+        dlon = numpy.diff(lon)
+        dlon = (dlon + math.pi) % (2 * math.pi) - math.pi
+        return numpy.hypot(m * numpy.diff(lat), n * numpy.cos(lat_mid) * dlon)
+    def __distances_python(self, lon, lat, pairs):
+        dist = list()
+        if self.__method == 'karney':
+            inverse = Geodesic.WGS84.Inverse
+            for i in pairs:
+                dist.append(inverse(lat[i-1],lon[i-1],lat[i],lon[i],
+                    Geodesic.DISTANCE)['s12'])
+            return dist
+        a, e2 = self.__a, self.__e2
+        rad = math.pi / 180
+        for i in pairs:
+            lat_mid = (lat[i] + lat[i-1]) * rad / 2
+            w2 = 1 - e2 * math.sin(lat_mid) ** 2
+            dlon = ((lon[i] - lon[i-1]) * rad + math.pi) % (2 * math.pi) - math.pi
+            dist.append(math.hypot(a * (1 - e2) / (w2 * math.sqrt(w2))
+                * (lat[i] - lat[i-1]) * rad,
+                a / math.sqrt(w2) * math.cos(lat_mid) * dlon))
+        return dist
+    def calc(self, track):
+        if numpy is not None:
+            return self.__calc_numpy(track)
+        return self.__calc_python(track)
+    def __calc_numpy(self, track):
+        lon = numpy.frombuffer(track.lon, dtype=numpy.float64)
+        lat = numpy.frombuffer(track.lat, dtype=numpy.float64)
+        # second points of the pairs
+        pairs = numpy.nonzero(self.__pair_mask(track))[0] + 1
+        if track.has_timestamps:
+            times = numpy.frombuffer(track.time, dtype=numpy.float64)
+            dt = times[pairs] - times[pairs - 1]
+            # points with the same time are skipped
+            pairs = pairs[dt != 0]
+            dt = dt[dt != 0]
+        dist = self.__distances_numpy(lon, lat)[pairs - 1]
+        cum_dist = numpy.concatenate(([0.0], numpy.cumsum(dist)))
         statistics = dict()
-        lines = list()
-        n = 0
-        for track_segm in self.__track:
-            for i in range(1,len(track_segm)):
-                n += 1
-                p1 = track_segm[i-1]
-                p2 = track_segm[i]
-                dist = Geodesic.WGS84.Inverse(p1['lat'],p1['lon'],p2['lat'],p2['lon'])['s12']
-                ln = [dist]
-                if self.__has_timestamps:
-                    if p2['timestamp'] == p1['timestamp']:
-                        continue
-                    else:
-                        ln.append(p2['timestamp'] - p1['timestamp'])
-                        #logger.debug('{} lat1 {} lon1 {} lat2 {} lon2 {} dist {} tm {} spd {}'.format(
-                        #    n,
-                        #    p1['lat'],
-                        #    p1['lon'],
-                        #    p2['lat'],
-                        #    p2['lon'],
-                        #    dist,
-                        #    p2['timestamp'] - p1['timestamp'],
-                        #    dist/(p2['timestamp'] - p1['timestamp'])
-                        #    ));
-                lines.append(ln)
-        trk_length = sum([l[0] for l in lines])
-        statistics['length'] = trk_length
-        if self.__has_timestamps:
-            trk_time = sum([l[1] for l in lines])
-            trk_movelength = sum([l[0] for l in lines if l[0]/l[1]>self.__min_movespeed])
-            trk_movetime = sum([l[1] for l in lines if l[0]/l[1]>self.__min_movespeed])
-            #to estimate maxspeed we will take at least <sec> seconds interval
-            sec = 5.0
-            npnt = int(math.ceil( float( sec / lines[0][1]) ))
-            npnt = min(npnt,len(lines))
-            logger.debug('npnt: {}'.format(npnt));
-            #trk_maxspeed = max([l[0]/l[1] for l in lines])
-            trk_maxspeed = 0.0
-            for i in range(npnt-1,len(lines)):
-                speed = ( sum([lines[j][0] for j in range(i-npnt+1,i+1)]) /
-                        sum([lines[j][1] for j in range(i-npnt+1,i+1)]) )
-                trk_maxspeed = max([trk_maxspeed, speed])
-            trk_starttime = self.__track[0][0]['timestamp']
-            trk_endtime = self.__track[-1][-1]['timestamp']
-            statistics['time'] = trk_time
-            statistics['speed'] = trk_length/trk_time
-            statistics['movetime'] = trk_movetime
-            statistics['movespeed'] = trk_movelength/trk_movetime
-            statistics['maxspeed'] = trk_maxspeed
-            statistics['starttime'] = trk_starttime
-            statistics['endtime'] = trk_endtime
-        self.__statistics = statistics
-        logger.debug('gpx statistics: {}'.format(statistics)) 
+        statistics['length'] = float(dist.sum())
+        if track.has_elevation and len(pairs) > 0:
+            self.__elevation_numpy(track, pairs, dist, cum_dist, statistics)
+        if not track.has_timestamps:
+            return statistics
+        speed = dist / dt
+        moving = speed > self.min_movespeed
+        statistics['time'] = float(dt.sum())
+        statistics['movetime'] = float(dt[moving].sum())
+        if statistics['movetime'] > 0:
+            statistics['movespeed'] = (float(dist[moving].sum()) /
+                statistics['movetime'])
+        band = numpy.searchsorted(self.speed_bins, speed * 3.6,
+            side='right') - 1
+        statistics['speedhist'] = numpy.bincount(band, weights=dt,
+            minlength=len(self.speed_bins)).tolist()
+        # cumulative time, window i is (start[i], i + 1]
+        cum_time = numpy.concatenate(([0.0], numpy.cumsum(dt)))
+        num_splits = int(cum_dist[-1] // self.split_length)
+        statistics['splits'] = numpy.diff(numpy.interp(
+            numpy.arange(num_splits + 1) * self.split_length,
+            cum_dist, cum_time)).tolist()
+        start = numpy.searchsorted(cum_time,
+            cum_time[1:] - self.max_speed_window, side='right') - 1
+        end = numpy.arange(1, len(cum_time))[start >= 0]
+        start = start[start >= 0]
+        if len(start) > 0:
+            statistics['maxspeed'] = float(numpy.max(
+                (cum_dist[end] - cum_dist[start]) /
+                (cum_time[end] - cum_time[start])))
+        elif statistics['time'] > 0:
+            statistics['maxspeed'] = statistics['length'] / statistics['time']
+        self.__add_times(track, statistics)
         return statistics
+    def __elevation_numpy(self, track, pairs, dist, cum_dist, statistics):
+        ele = numpy.frombuffer(track.ele, dtype=numpy.float64)
+        # only turning points matter for ascent and descent
+        turns = ele[numpy.concatenate(([True], numpy.diff(ele) != 0))]
+        if len(turns) > 2:
+            sign = numpy.sign(numpy.diff(turns))
+            turns = turns[numpy.concatenate(([True], sign[1:] != sign[:-1],
+                [True]))]
+        statistics['ascent'], statistics['descent'] = elevation_gain(
+            turns.tolist(), self.elevation_threshold)
+        statistics['minele'] = float(ele.min())
+        statistics['maxele'] = float(ele.max())
+        edges = elevation_bands(statistics['minele'], statistics['maxele'])
+        band = numpy.searchsorted(edges, (ele[pairs] + ele[pairs - 1]) / 2,
+            side='right') - 1
+        statistics['elehist'] = (edges, numpy.bincount(
+            numpy.minimum(band, len(edges) - 2), weights=dist,
+            minlength=len(edges) - 1).tolist())
+        profile_ele = ele[numpy.concatenate((pairs[:1] - 1, pairs))]
+        statistics['profile'] = [[float(cum_dist[i]), float(profile_ele[i])]
+            for i in sample_indexes(len(cum_dist), self.profile_points)]
+    def __calc_python(self, track):
+        lon, lat, times = track.lon, track.lat, track.time
+        pairs = [i for first, end in track.get_segments()
+            for i in range(first + 1, end)]
+        if track.has_timestamps:
+            pairs = [i for i in pairs if times[i] != times[i-1]]
+        dist = self.__distances_python(lon, lat, pairs)
+        statistics = dict()
+        statistics['length'] = math.fsum(dist)
+        if track.has_elevation and len(pairs) > 0:
+            self.__elevation_python(track, pairs, dist, statistics)
+        if not track.has_timestamps:
+            return statistics
+        dt = [times[i] - times[i-1] for i in pairs]
+        movelength = movetime = 0.0
+        maxspeed = None
+        speedhist = [0.0] * len(self.speed_bins)
+        splits = list()
+        split_end = self.split_length
+        split_start_time = 0.0
+        total_dist = total_time = 0.0
+        # sliding window [start, i] at least max_speed_window long
+        start = 0
+        window_dist = window_time = 0.0
+        for i in range(len(dist)):
+            speed = dist[i] / dt[i]
+            if speed > self.min_movespeed:
+                movelength += dist[i]
+                movetime += dt[i]
+            speedhist[bisect.bisect_right(self.speed_bins, speed * 3.6) - 1] += dt[i]
+            while total_dist + dist[i] >= split_end:
+                # time at split_end, the pair is passed at constant speed
+                split_time = (total_time + dt[i] *
+                    (split_end - total_dist) / dist[i])
+                splits.append(split_time - split_start_time)
+                split_start_time = split_time
+                split_end += self.split_length
+            total_dist += dist[i]
+            total_time += dt[i]
+            window_dist += dist[i]
+            window_time += dt[i]
+            while window_time - dt[start] >= self.max_speed_window:
+                window_dist -= dist[start]
+                window_time -= dt[start]
+                start += 1
+            if (window_time >= self.max_speed_window and
+                    (maxspeed is None or window_dist / window_time > maxspeed)):
+                maxspeed = window_dist / window_time
+        statistics['time'] = math.fsum(dt)
+        statistics['movetime'] = movetime
+        if movetime > 0:
+            statistics['movespeed'] = movelength / movetime
+        if maxspeed is None and statistics['time'] > 0:
+            maxspeed = statistics['length'] / statistics['time']
+        if maxspeed is not None:
+            statistics['maxspeed'] = maxspeed
+        statistics['speedhist'] = speedhist
+        statistics['splits'] = splits
+        self.__add_times(track, statistics)
+        return statistics
+    def __elevation_python(self, track, pairs, dist, statistics):
+        ele = track.ele
+        statistics['ascent'], statistics['descent'] = elevation_gain(ele,
+            self.elevation_threshold)
+        statistics['minele'] = min(ele)
+        statistics['maxele'] = max(ele)
+        edges = elevation_bands(statistics['minele'], statistics['maxele'])
+        elehist = [0.0] * (len(edges) - 1)
+        cum_dist = [0.0]
+        for k in range(len(pairs)):
+            i = pairs[k]
+            band = bisect.bisect_right(edges, (ele[i] + ele[i-1]) / 2) - 1
+            elehist[min(band, len(elehist) - 1)] += dist[k]
+            cum_dist.append(cum_dist[-1] + dist[k])
+        statistics['elehist'] = (edges, elehist)
+        profile_ele = [ele[pairs[0] - 1]] + [ele[i] for i in pairs]
+        statistics['profile'] = [[cum_dist[i], profile_ele[i]]
+            for i in sample_indexes(len(cum_dist), self.profile_points)]
+    def __add_times(self, track, statistics):
+        """ speeds are left out if there is no time to divide by """
+        if statistics['time'] > 0:
+            statistics['speed'] = statistics['length'] / statistics['time']
+        if track.get_num_points() > 0:
+            statistics['starttime'] = track.time[0]
+            statistics['endtime'] = track.time[-1]
+
+def elevation_gain(ele, threshold):
+    """ (ascent, descent), a climb or a drop is counted when elevation
+        goes back from its extreme by threshold or more (hysteresis) """
+    ascent = descent = 0.0
+    if len(ele) == 0:
+        return ascent, descent
+    # last turning point, extreme since it, direction (None until known)
+    low = high = ele[0]
+    turn = extreme = ele[0]
+    up = None
+    for e in ele:
+        if up is None:
+            low, high = min(low, e), max(high, e)
+            if e - low >= threshold:
+                up, turn, extreme = True, low, e
+            elif high - e >= threshold:
+                up, turn, extreme = False, high, e
+        elif up:
+            if e > extreme:
+                extreme = e
+            elif extreme - e >= threshold:
+                ascent += extreme - turn
+                up, turn, extreme = False, extreme, e
+        else:
+            if e < extreme:
+                extreme = e
+            elif e - extreme >= threshold:
+                descent += turn - extreme
+                up, turn, extreme = True, extreme, e
+    if up is True:
+        ascent += extreme - turn
+    elif up is False:
+        descent += turn - extreme
+    return ascent, descent
+
+def elevation_bands(minele, maxele, max_bands=8):
+    """ edges of elevation bands, a round step giving max_bands or less """
+    for step in (10, 20, 50, 100, 200, 500, 1000, 2000, 5000):
+        first = math.floor(minele / step) * step
+        num = max(1, int(math.ceil((maxele - first) / step)))
+        if maxele >= first + num * step:
+            num += 1
+        if num <= max_bands:
+            break
+    return [first + i * step for i in range(num + 1)]
+
+def sample_indexes(length, num):
+    """ num or less indexes spread evenly over range(length), ends included """
+    if length <= num:
+        return range(length)
+    return [i * (length - 1) // (num - 1) for i in range(num)]
+
+def mercator_pixels(lon, lat, zoom):
+    """ web mercator pixel coordinates at zoom (0, 0 is top left) """
+    scale = 256 * 2**zoom
+    lat = math.radians(max(-85.0511, min(85.0511, lat)))
+    return ((lon + 180.0) / 360.0 * scale,
+        (1 - math.log(math.tan(math.pi / 4 + lat / 2)) / math.pi) / 2 * scale)
+
+def simplify_radial(x, y, points, tolerance):
+    """ drop points closer than tolerance to the previous kept one """
+    if len(points) < 3:
+        return points
+    tol2 = tolerance * tolerance
+    kept = [points[0]]
+    px, py = x[points[0]], y[points[0]]
+    for i in points[1:-1]:
+        if (x[i] - px) ** 2 + (y[i] - py) ** 2 > tol2:
+            kept.append(i)
+            px, py = x[i], y[i]
+    kept.append(points[-1])
+    return kept
+
+def simplify_dp(x, y, points, tolerance):
+    """ Douglas-Peucker, points farther than tolerance from the line
+        between kept ones are kept """
+    if len(points) < 3:
+        return points
+    tol2 = tolerance * tolerance
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while len(stack) > 0:
+        first, last = stack.pop()
+        ax, ay = x[points[first]], y[points[first]]
+        dx, dy = x[points[last]] - ax, y[points[last]] - ay
+        length2 = dx * dx + dy * dy
+        max_dist2, max_k = tol2, None
+        for k in range(first + 1, last):
+            i = points[k]
+            if length2 == 0:
+                dist2 = (x[i] - ax) ** 2 + (y[i] - ay) ** 2
+            else:
+                dist2 = ((x[i] - ax) * dy - (y[i] - ay) * dx) ** 2 / length2
+            if dist2 > max_dist2:
+                max_dist2, max_k = dist2, k
+        if max_k is not None:
+            keep[max_k] = True
+            stack.append((first, max_k))
+            stack.append((max_k, last))
+    return [points[k] for k in range(len(points)) if keep[k]]
+
+def simplify_vw(x, y, points, tolerance):
+    """ Visvalingam-Whyatt, points making triangles smaller than
+        tolerance^2 with their neighbours are removed, smallest first """
+    if len(points) < 3:
+        return points
+    min_area = tolerance * tolerance
+    def area(a, b, c):
+        ia, ib, ic = points[a], points[b], points[c]
+        return abs((x[ib] - x[ia]) * (y[ic] - y[ia])
+            - (x[ic] - x[ia]) * (y[ib] - y[ia])) / 2
+    before = list(range(-1, len(points) - 1))
+    after = list(range(1, len(points) + 1))
+    areas = [None] * len(points)
+    heap = list()
+    for k in range(1, len(points) - 1):
+        areas[k] = area(k - 1, k, k + 1)
+        heap.append((areas[k], k))
+    heapq.heapify(heap)
+    removed = [False] * len(points)
+    while len(heap) > 0:
+        a, k = heapq.heappop(heap)
+        if removed[k] or a != areas[k]:
+            # outdated heap entry
+            continue
+        if a >= min_area:
+            break
+        removed[k] = True
+        p, n = before[k], after[k]
+        after[p], before[n] = n, p
+        # area of neighbours can't become less than of the removed point
+        for j in (p, n):
+            if 0 < j < len(points) - 1:
+                areas[j] = max(a, area(before[j], j, after[j]))
+                heapq.heappush(heap, (areas[j], j))
+    return [points[k] for k in range(len(points)) if not removed[k]]
+
+simplify_algorithms = {'dp': simplify_dp, 'vw': simplify_vw}
+
+class Track(object):
+    """ Track points in flat arrays, segments are ranges of points """
+    __slots__ = ('lon', 'lat', 'time', 'ele', 'segments', 'has_timestamps',
+        'has_elevation', 'bbox')
+    def __init__(self):
+        self.lon = array('d')
+        self.lat = array('d')
+        # seconds since epoch, nan if point has no time
+        self.time = array('d')
+        # meters, nan if point has no elevation
+        self.ele = array('d')
+        # indexes of the first points of segments
+        self.segments = array('l')
+        self.has_timestamps = True
+        self.has_elevation = True
+        self.bbox = {'xmin':1000, 'ymin':1000, 'xmax':-1000, 'ymax':-1000 }
+    def __getstate__(self):
+        return (self.lon, self.lat, self.time, self.ele, self.segments,
+            self.has_timestamps, self.has_elevation, self.bbox)
+    def __setstate__(self, state):
+        (self.lon, self.lat, self.time, self.ele, self.segments,
+            self.has_timestamps, self.has_elevation, self.bbox) = state
+    def add_segment(self, lon, lat, times, ele=None):
+        if ele is None:
+            ele = array('d', [float('nan')]) * len(lon)
+        self.segments.append(len(self.lon))
+        self.lon.extend(lon)
+        self.lat.extend(lat)
+        self.time.extend(times)
+        self.ele.extend(ele)
+        if len(lon) > 0:
+            self.bbox['xmin'] = min(self.bbox['xmin'],min(lon))
+            self.bbox['xmax'] = max(self.bbox['xmax'],max(lon))
+            self.bbox['ymin'] = min(self.bbox['ymin'],min(lat))
+            self.bbox['ymax'] = max(self.bbox['ymax'],max(lat))
+        if self.has_timestamps:
+            self.has_timestamps = not any([math.isnan(t) for t in times])
+        if self.has_elevation:
+            self.has_elevation = not any([math.isnan(e) for e in ele])
     def get_num_points(self):
-        return self.__num_points
-    def get_json(self):
-        if self.__num_points == 0:
+        return len(self.lon)
+    def get_segments(self):
+        """ (first, last + 1) point indexes of segments """
+        ends = list(self.segments[1:]) + [len(self.lon)]
+        return zip(self.segments, ends)
+    def get_point(self, i):
+        return {'lon':self.lon[i],'lat':self.lat[i]}
+    def simplified(self, zoom, tolerance, algorithm):
+        """ track without points which don't change the picture at zoom,
+            tolerance is in pixels, segment ends are always kept """
+        if algorithm == 'none':
+            return self
+        pixels = [mercator_pixels(self.lon[i], self.lat[i], zoom)
+            for i in range(len(self.lon))]
+        x = [p[0] for p in pixels]
+        y = [p[1] for p in pixels]
+        simplify = simplify_algorithms[algorithm]
+        track = Track()
+        for first, end in self.get_segments():
+            points = simplify_radial(x, y, range(first, end), tolerance / 2)
+            points = simplify(x, y, points, tolerance)
+            track.add_segment(array('d', [self.lon[i] for i in points]),
+                array('d', [self.lat[i] for i in points]),
+                array('d', [self.time[i] for i in points]),
+                array('d', [self.ele[i] for i in points]))
+        return track
+    def calc_statistics(self, method='fast'):
+        statistics = StatisticsEngine(method).calc(self)
+        logger.debug('gpx statistics: {}'.format(statistics)) 
+        return statistics
+    def get_feature(self, precision=6, color="#ff2b00"):
+        """ GeoJSON feature, all segments in one MultiLineString """
+        if len(self.lon) == 0:
             raise GPXParseException("GPX file is empty, cannot create JSON")
+        coordinates = list()
+        for first, end in self.get_segments():
+            coordinates.append([ [ round(self.lon[i], precision),
+                round(self.lat[i], precision) ] for i in range(first, end) ])
+        return {
+                "type" : "Feature",
+                "properties" : { "color": color, "stroke": color, "stroke-width": 2, "stroke-opacity": 1 },
+                "geometry" : { "type" : "MultiLineString", "coordinates" : coordinates }
+            }
+    def get_json(self, precision=6):
+        """ compact GeoJSON """
         track_json = {
             "type" : "FeatureCollection",
-            "features" : list()
+            "features" : [ self.get_feature(precision) ]
         }
-        for track_segm in self.__track:
-            coordinates = [ [ p['lon'], p['lat'] ] for p in track_segm ]
-        track_json['features'].append(
-            {
-                "type" : "Feature",
-                "properties" : { "stroke": "#ff2b00", "stroke-width": 2, "stroke-opacity": 1 },
-                "geometry" : { "type" : "LineString", "coordinates" : coordinates }
-            })
-        return json.dumps(track_json,indent=2)
+        return json.dumps(track_json,separators=(',',':'))
+    def get_wkb(self):
+        """ all segments as WKB MultiLineString (native byte order) """
+        if len(self.lon) == 0:
+            raise GPXParseException("GPX file is empty, cannot create WKB")
+        byte_order = struct.pack('B', 1 if sys.byteorder == 'little' else 0)
+        segments = self.get_segments()
+        wkb = [byte_order, struct.pack('=II', 5, len(segments))]
+        for first, end in segments:
+            coordinates = array('d', [0.0]) * (2 * (end - first))
+            coordinates[0::2] = self.lon[first:end]
+            coordinates[1::2] = self.lat[first:end]
+            wkb += [byte_order, struct.pack('=II', 2, end - first),
+                coordinates.tostring()]
+        return b''.join(wkb)
     def get_bbox(self):
-        if self.__num_points == 0:
+        if len(self.lon) == 0:
             raise GPXParseException("GPX file is empty, cannot create bbox")
-        return self.__bbox
-    def get_multiline(self):
-        if self.__num_points == 0:
-            raise GPXParseException("GPX file is empty, cannot create bbox")
-        return self.__track
+        return self.bbox
+
+class GpxReader:
+    """ Streaming GPX reader (GPX 1.0, 1.1 or no namespace), track points
+        are read segment by segment and every parsed element (waypoints,
+        routes, extensions too) is dropped as soon as it ends, so only
+        the point arrays grow """
+    def __init__(self, max_points):
+        self.__max_points = max_points
+    def segments(self, f):
+        """ yields (lon, lat, times, ele) arrays for every track segment """
+        num_points = 0
+        lon, lat, times, ele = None, None, None, None
+        for event, el in etree.iterparse(f, events=('end',),
+                resolve_entities=False, no_network=True):
+            tag = el.tag
+            if tag.endswith('trkpt') and el.getparent().tag.endswith('trkseg'):
+                if lon is None:
+                    lon, lat = array('d'), array('d')
+                    times, ele = array('d'), array('d')
+                num_points += 1
+                if num_points > self.__max_points:
+                    raise GPXTooBigException('more than {0} points'.format(
+                        self.__max_points))
+                lon.append(float(el.get('lon')))
+                lat.append(float(el.get('lat')))
+                timestamp = el.findtext('{*}time')
+                if timestamp is None:
+                    times.append(float('nan'))
+                else:
+                    times.append(parse_timestamp(timestamp))
+                elevation = el.findtext('{*}ele')
+                if elevation is None:
+                    ele.append(float('nan'))
+                else:
+                    ele.append(float(elevation))
+            elif tag.endswith('trkseg'):
+                if lon is None:
+                    lon, lat = array('d'), array('d')
+                    times, ele = array('d'), array('d')
+                yield lon, lat, times, ele
+                lon, lat, times, ele = None, None, None, None
+            else:
+                parent = el.getparent()
+                if parent is not None and parent.tag.endswith('trkpt'):
+                    # time and ele are read when the point ends
+                    continue
+            # drop the element and everything parsed before it,
+            # comments and PIs before the root are siblings of the root
+            el.clear()
+            parent = el.getparent()
+            if parent is None:
+                continue
+            while el.getprevious() is not None:
+                del parent[0]
+    def read(self, f):
+        logger.info('read gpx XML')
+        track = Track()
+        try:
+            for lon, lat, times, ele in self.segments(f):
+                track.add_segment(lon, lat, times, ele)
+        except etree.XMLSyntaxError as e:
+            raise GPXParseException('XML error: {0}'.format(e))
+        except (TypeError, ValueError) as e:
+            raise GPXParseException('wrong point: {0}'.format(e))
+        logger.debug('gpx has timestamps: {}'.format(track.has_timestamps))
+        logger.info("end of the gpx XML,"+
+                " {0} points found".format(track.get_num_points()))
+        return track
 
 def timestamp2hhmmss(ts):
+    ts = int(round(ts))
     hh = ts/3600
     mm = ts/60 - hh*60
     ss = ts - mm*60 - hh*3600
     return "{:02d}:{:02d}:{:02d}".format(hh,mm,ss)
 
 
-def gpx_draw(gpx_path,fmt,zoom,color,width):
-    image_path = ''.join([options['folder_images'],'/',
-            os.path.splitext(os.path.basename(gpx_path))[0],
-            '.',fmt])
-    json_path = ''.join([
-            os.path.splitext(gpx_path)[0],
-            '.geojson'])
-    gpx = Gpx2JSONTarget();
-    parser = etree.XMLParser(target=gpx);
-    f=open(gpx_path,"r");
-    etree.parse(f,parser);
-    f.close();
-    f=open(json_path,"w");
-    f.write(gpx.get_json())
+class Workspace:
+    """ Job scratch directory, removed with all the content on exit """
+    def __init__(self, manager, size):
+        self.__manager = manager
+        self.__size = size
+        self.folder = None
+    def __enter__(self):
+        self.folder = self.__manager.acquire(self.__size)
+        return self
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.__manager.release(self.folder, self.__size)
+        return False
+    def path(self, name):
+        return os.path.join(self.folder, name)
+
+class WorkspaceManager:
+    """ Creates job workspaces, limits total reserved disk space """
+    def __init__(self, folder, max_bytes):
+        self.__folder = folder
+        self.__max_bytes = max_bytes
+        self.__used = 0
+        self.__cond = threading.Condition()
+    def workspace(self, size):
+        """ workspace for the job which needs size bytes, use it with 'with' """
+        return Workspace(self, size)
+    def acquire(self, size):
+        """ reserve space (wait for other jobs if needed), create folder """
+        if size > self.__max_bytes:
+            raise WorkspaceFullException('{0} bytes needed, limit is {1}'.format(
+                size, self.__max_bytes))
+        with self.__cond:
+            while self.__used + size > self.__max_bytes:
+                self.__cond.wait()
+            self.__used += size
+        try:
+            return tempfile.mkdtemp(prefix='drawgpxbot-', dir=self.__folder)
+        except:
+            self.release(None, size)
+            raise
+    def release(self, folder, size):
+        if folder is not None:
+            shutil.rmtree(folder, ignore_errors=True)
+        with self.__cond:
+            self.__used -= size
+            self.__cond.notify_all()
+
+def default_folder_work():
+    """ tmpfs if there is one """
+    if os.path.isdir('/dev/shm'):
+        return '/dev/shm'
+    return options['folder_gpx']
+
+workspaces = WorkspaceManager(options.get('folder_work', default_folder_work()),
+    int(options.get('workspace_max_mb', 256)) * 1024 * 1024)
+
+class RenderCache:
+    """ Rendered images on disk, the least recently used and the old ones
+        are removed, Telegram file_id of the uploaded image is kept too """
+    def __init__(self, folder, max_bytes, max_age):
+        self.__folder = folder
+        self.__max_bytes = max_bytes
+        self.__max_age = max_age
+        self.__lock = threading.Lock()
+        # key -> [size, last use time], the most recently used at the end
+        self.__entries = OrderedDict()
+        self.__size = 0
+        self.hits = 0
+        self.misses = 0
+        entries = list()
+        for name in os.listdir(folder):
+            if re.match('^[0-9a-f]{40}$', name) is not None:
+                path = os.path.join(folder, name)
+                entries.append((os.path.getmtime(path), name,
+                    os.path.getsize(path)))
+        for mtime, key, size in sorted(entries):
+            self.__entries[key] = [size, mtime]
+            self.__size += size
+        logger.info('render cache: {0} images, {1} bytes'.format(
+            len(self.__entries), self.__size))
+    @staticmethod
+    def key(track_id, fmt, zoom, color, width):
+        """ track_id is Telegram file_unique_id or hash of gpx data """
+        style = options['mapnik_style_xml']
+        return hashlib.sha1(u'{0}|{1}|{2}|{3}|{4}|{5}'.format(track_id, fmt,
+            zoom, color, width, os.path.getmtime(style)).encode('utf-8')).hexdigest()
+    def __path(self, key):
+        return os.path.join(self.__folder, key)
+    def __contains__(self, key):
+        with self.__lock:
+            return key in self.__entries
+    def lookup(self, key):
+        """ True if the image is cached, counted as a hit or a miss """
+        with self.__lock:
+            if key in self.__entries:
+                self.hits += 1
+                return True
+            self.misses += 1
+            return False
+    def get(self, key):
+        """ returns (image path, file_id), file_id and path may be None """
+        with self.__lock:
+            if key not in self.__entries:
+                return None, None
+            entry = self.__entries.pop(key)
+            entry[1] = time.time()
+            self.__entries[key] = entry
+        path = self.__path(key)
+        file_id = None
+        try:
+            os.utime(path, None)
+            if os.path.exists(path + '.fileid'):
+                f=open(path + '.fileid',"r");
+                file_id = f.read().strip()
+                f.close();
+        except OSError:
+            path = None
+        return path, file_id
+    def put(self, key, image):
+        path = self.__path(key)
+        f=open(path + '.tmp',"wb");
+        f.write(image)
+        f.close();
+        os.rename(path + '.tmp', path)
+        with self.__lock:
+            if key in self.__entries:
+                self.__size -= self.__entries.pop(key)[0]
+            self.__entries[key] = [len(image), time.time()]
+            self.__size += len(image)
+            expired = self.__evict()
+        for old_key in expired:
+            for old_path in (self.__path(old_key), self.__path(old_key) + '.fileid'):
+                if os.path.exists(old_path):
+                    os.remove(old_path)
+        logger.debug('render cache: {0} images, {1} bytes'.format(
+            len(self.__entries), self.__size))
+    def set_file_id(self, key, file_id):
+        """ remember the id of the image uploaded to Telegram """
+        f=open(self.__path(key) + '.fileid',"w");
+        f.write(file_id)
+        f.close();
+    def forget_file_id(self, key):
+        if os.path.exists(self.__path(key) + '.fileid'):
+            os.remove(self.__path(key) + '.fileid')
+    def __evict(self):
+        """ drop old and least recently used entries, returns their keys """
+        expired = list()
+        min_time = time.time() - self.__max_age
+        while len(self.__entries) > 0:
+            key, (size, last_use) = next(iter(self.__entries.items()))
+            if self.__size <= self.__max_bytes and last_use >= min_time:
+                break
+            del self.__entries[key]
+            self.__size -= size
+            expired.append(key)
+        return expired
+
+render_cache = RenderCache(options['folder_images'],
+    int(options.get('render_cache_max_mb', 512)) * 1024 * 1024,
+    float(options.get('render_cache_max_days', 30)) * 24 * 3600)
+
+def check_gpx_size(size):
+    max_bytes = int(options.get('gpx_max_mb', 50)) * 1024 * 1024
+    if size is not None and size > max_bytes:
+        raise GPXTooBigException('{0} bytes, limit is {1}'.format(
+            size, max_bytes))
+
+class BlobCache:
+    """ Downloaded GPX files by Telegram file_unique_id (or file_id),
+        the least recently used are removed unless some job uses them """
+    def __init__(self, folder, max_bytes):
+        self.__folder = folder
+        self.__max_bytes = max_bytes
+        self.__cond = threading.Condition()
+        # key -> size, the most recently used at the end
+        self.__entries = OrderedDict()
+        self.__size = 0
+        # key -> number of jobs using the file
+        self.__pinned = dict()
+        # keys being downloaded
+        self.__downloading = set()
+        entries = list()
+        for name in os.listdir(folder):
+            if name.endswith('.gpx'):
+                path = os.path.join(folder, name)
+                entries.append((os.path.getmtime(path), name[:-4],
+                    os.path.getsize(path)))
+        for mtime, key, size in sorted(entries):
+            self.__entries[key] = size
+            self.__size += size
+        logger.info('gpx cache: {0} files, {1} bytes'.format(
+            len(self.__entries), self.__size))
+    @staticmethod
+    def key(document):
+        track_id = getattr(document, 'file_unique_id', None) or document.file_id
+        return re.sub('[^A-Za-z0-9_-]', '_', track_id)
+    def __path(self, key):
+        return os.path.join(self.__folder, key + '.gpx')
+    def fetch(self, document):
+        """ download the file unless it is here already """
+        check_gpx_size(document.file_size)
+        key = self.key(document)
+        with self.__cond:
+            while key in self.__downloading:
+                self.__cond.wait()
+            if key in self.__entries:
+                self.__entries[key] = self.__entries.pop(key)
+                return self.__path(key)
+            self.__downloading.add(key)
+        path = self.__path(key)
+        try:
+            document.get_file().download(custom_path=path + '.part')
+            os.rename(path + '.part', path)
+            size = os.path.getsize(path)
+            logger.debug(u'downloaded gpx {0} to {1}'.format(
+                document.file_name, path))
+            with self.__cond:
+                self.__entries[key] = size
+                self.__size += size
+                expired = self.__evict()
+        finally:
+            with self.__cond:
+                self.__downloading.discard(key)
+                self.__cond.notify_all()
+        for old_key in expired:
+            os.remove(self.__path(old_key))
+        return path
+    @contextmanager
+    def open(self, document):
+        """ path to the local copy, it is kept until the 'with' block ends """
+        key = self.key(document)
+        with self.__cond:
+            self.__pinned[key] = self.__pinned.get(key, 0) + 1
+        try:
+            yield self.fetch(document)
+        finally:
+            with self.__cond:
+                self.__pinned[key] -= 1
+                if self.__pinned[key] == 0:
+                    del self.__pinned[key]
+    def __evict(self):
+        """ drop least recently used files, returns their keys """
+        expired = list()
+        for key in list(self.__entries.keys()):
+            if self.__size <= self.__max_bytes:
+                break
+            if key in self.__pinned:
+                continue
+            self.__size -= self.__entries.pop(key)
+            expired.append(key)
+        return expired
+
+blob_cache = BlobCache(options['folder_gpx'],
+    int(options.get('gpx_cache_max_mb', 256)) * 1024 * 1024)
+
+def file_sha1(path):
+    f=open(path,"rb");
+    digest = hashlib.sha1(f.read()).hexdigest()
     f.close();
-    logger.debug('created json {0}'.format(json_path))
-    bbox = gpx.get_bbox()
-    logger.debug('json bbox {0}'.format(str(bbox)))
-    # add margins
-    xmin = bbox['xmin'] - (bbox['xmax'] - bbox['xmin']) * 0.05 
-    ymin = bbox['ymin'] - (bbox['ymax'] - bbox['ymin']) * 0.05 
-    xmax = bbox['xmax'] + (bbox['xmax'] - bbox['xmin']) * 0.05 
-    ymax = bbox['ymax'] + (bbox['ymax'] - bbox['ymin']) * 0.05 
+    return digest
+
+class MapnikRenderer:
+    """ In-process Mapnik renderer, keeps parsed styles between renders """
+    __earth_circumference = 40075016.686
+    __tile_size = 256
+    def __init__(self, style_xml, track_layer, fonts=None, max_styles=4):
+        logger.info('load mapnik style {0}'.format(style_xml))
+        self.__style_path = os.path.dirname(os.path.abspath(style_xml))
+        f=open(style_xml,"r");
+        self.__style = f.read()
+        f.close();
+        self.__track_layer = track_layer
+        self.__max_styles = max_styles
+        # ${track_geojson} of nik4 styles, the layer gets the track later
+        self.__empty_geojson = tempfile.NamedTemporaryFile(
+            prefix='drawgpx-empty-', suffix='.geojson')
+        self.__empty_geojson.write('{"type":"FeatureCollection","features":[]}')
+        self.__empty_geojson.flush()
+        # loaded maps by style vars, the most recently used at the end
+        self.__maps = list()
+        self.__lock = threading.Lock()
+        if fonts is not None:
+            mapnik.register_fonts(fonts)
+    def __get_map(self, style_vars):
+        """ parse style with nik4-like ${var} substitution, or reuse parsed """
+        for i in range(len(self.__maps)):
+            if self.__maps[i][0] == style_vars:
+                self.__maps.append(self.__maps.pop(i))
+                return self.__maps[-1][1]
+        style = self.__style
+        for k, v in style_vars + (('track_geojson', self.__empty_geojson.name),):
+            style = style.replace('${' + k + '}', str(v))
+        m = mapnik.Map(self.__tile_size, self.__tile_size)
+        mapnik.load_map_from_string(m, style, False, self.__style_path)
+        logger.info('mapnik style loaded for {0}'.format(style_vars))
+        self.__maps.append((style_vars, m))
+        if len(self.__maps) > self.__max_styles:
+            self.__maps.pop(0)
+        return m
+    def __pixel_box(self, zoom, x, y, size_x, size_y):
+        """ web mercator box of the area of pixels at zoom """
+        scale = self.__earth_circumference / self.__tile_size / 2**zoom
+        half = self.__earth_circumference / 2
+        return mapnik.Box2d(x * scale - half, half - (y + size_y) * scale,
+            (x + size_x) * scale - half, half - y * scale)
+    def __set_layers(self, m, base, track):
+        """ turn base map and track layers on/off,
+            returns function to restore them """
+        saved = [(layer, layer.active) for layer in m.layers]
+        background = m.background
+        for layer in m.layers:
+            layer.active = (layer.active and
+                (track if layer.name == self.__track_layer else base))
+        if not base:
+            m.background = mapnik.Color(0, 0, 0, 0)
+        def restore():
+            for layer, active in saved:
+                layer.active = active
+            m.background = background
+        return restore
+    def __attach_track(self, m, track_output, width):
+        """ set track layer datasource, tracks of different colors get
+            generated style, returns function to restore the layer """
+        restore = lambda: None
+        for layer in m.layers:
+            if layer.name != self.__track_layer:
+                continue
+            layer.datasource = track_output.datasource()
+            if len(set(track_output.colors)) < 2:
+                continue
+            style_name = 'gpx-colors-{0}'.format(width)
+            style = mapnik.Style()
+            for color in sorted(set(track_output.colors)):
+                symbolizer = mapnik.LineSymbolizer()
+                symbolizer.stroke = mapnik.Color(color)
+                symbolizer.stroke_width = float(width)
+                rule = mapnik.Rule()
+                rule.filter = mapnik.Expression("[color] = '{0}'".format(color))
+                rule.symbolizers.append(symbolizer)
+                style.rules.append(rule)
+            m.append_style(style_name, style)
+            styles = list(layer.styles)
+            del layer.styles[:]
+            layer.styles.append(style_name)
+            def restore(layer=layer, styles=styles):
+                del layer.styles[:]
+                for name in styles:
+                    layer.styles.append(name)
+        return restore
+    def __render_tile(self, m, zoom, x, y):
+        """ base map tile x, y without the track, PNG data """
+        restore = self.__set_layers(m, True, False)
+        try:
+            m.resize(self.__tile_size, self.__tile_size)
+            m.zoom_to_box(self.__pixel_box(zoom, x * self.__tile_size,
+                y * self.__tile_size, self.__tile_size, self.__tile_size))
+            image = mapnik.Image(self.__tile_size, self.__tile_size)
+            mapnik.render(m, image)
+        finally:
+            restore()
+        return image.tostring('png')
+    def render_tile(self, zoom, x, y):
+        with self.__lock:
+            m = self.__get_map((('track_color', options['track_color']),
+                                ('track_width', options['track_width'])))
+            return self.__render_tile(m, zoom, x, y)
+    def render_composite(self, track_output, bbox, zoom, color, width, tiles):
+        """ PNG of base map from the tile cache with the track drawn over it,
+            None if the style is not in web mercator """
+        with self.__lock:
+            m = self.__get_map((('track_color', color),
+                                ('track_width', width)))
+            if '3857' not in m.srs and '+proj=merc' not in m.srs:
+                return None
+            xmin, ymax = mercator_pixels(bbox[0], bbox[1], zoom)
+            xmax, ymin = mercator_pixels(bbox[2], bbox[3], zoom)
+            x0, y0 = int(math.floor(xmin)), int(math.floor(ymin))
+            size_x = max(1, int(math.ceil(xmax)) - x0)
+            size_y = max(1, int(math.ceil(ymax)) - y0)
+            image = mapnik.Image(size_x, size_y)
+            num_tiles = 2**zoom
+            hits, misses = tiles.hits, tiles.misses
+            for tx in range(x0 // self.__tile_size,
+                    (x0 + size_x - 1) // self.__tile_size + 1):
+                for ty in range(max(0, y0 // self.__tile_size),
+                        min(num_tiles, (y0 + size_y - 1) // self.__tile_size + 1)):
+                    tile = tiles.get(zoom, tx % num_tiles, ty,
+                        lambda z, x, y: self.__render_tile(m, z, x, y))
+                    image.composite(mapnik.Image.fromstring(tile),
+                        mapnik.CompositeOp.src_over, 1.0,
+                        tx * self.__tile_size - x0, ty * self.__tile_size - y0)
+            logger.info('tiles: {0} hits, {1} misses'.format(
+                tiles.hits - hits, tiles.misses - misses))
+            restore_track = self.__attach_track(m, track_output, width)
+            restore = self.__set_layers(m, False, True)
+            try:
+                m.resize(size_x, size_y)
+                m.zoom_to_box(self.__pixel_box(zoom, x0, y0, size_x, size_y))
+                overlay = mapnik.Image(size_x, size_y)
+                mapnik.render(m, overlay)
+            finally:
+                restore()
+                restore_track()
+            image.composite(overlay, mapnik.CompositeOp.src_over, 1.0, 0, 0)
+            return image.tostring('png')
+    def render(self, track_output, bbox, zoom, fmt, color, width):
+        """ render map, bbox is (xmin, ymin, xmax, ymax) in WGS84,
+            returns image data """
+        with self.__lock:
+            m = self.__get_map((('track_color', color),
+                                ('track_width', width)))
+            restore_track = self.__attach_track(m, track_output, width)
+            try:
+                return self.__render(m, bbox, zoom, fmt)
+            finally:
+                restore_track()
+    def __render(self, m, bbox, zoom, fmt):
+        transform = mapnik.ProjTransform(
+            mapnik.Projection('+init=epsg:4326'),
+            mapnik.Projection(m.srs))
+        box = transform.forward(mapnik.Box2d(*bbox))
+        scale = (self.__earth_circumference / self.__tile_size
+            / 2**zoom)
+        size_x = max(1, int(round(box.width() / scale)))
+        size_y = max(1, int(round(box.height() / scale)))
+        m.resize(size_x, size_y)
+        m.zoom_to_box(box)
+        logger.debug('mapnik render {0}x{1} px'.format(size_x, size_y))
+        if fmt == 'svg':
+            buf = io.BytesIO()
+            surface = cairo.SVGSurface(buf, size_x, size_y)
+            mapnik.render(m, surface)
+            surface.finish()
+            return buf.getvalue()
+        image = mapnik.Image(size_x, size_y)
+        mapnik.render(m, image)
+        return image.tostring(fmt)
+
+class GeoJSONTrackOutput:
+    """ Tracks as compact GeoJSON file, a feature with 'color' property
+        for every track """
+    def __init__(self, tracks, colors, work_folder):
+        self.colors = colors
+        self.path = os.path.join(work_folder, 'track.geojson')
+        precision = int(options.get('track_precision', 6))
+        track_json = {
+            "type" : "FeatureCollection",
+            "features" : [ track.get_feature(precision, color)
+                for track, color in zip(tracks, colors) ]
+        }
+        f=open(self.path,"w");
+        f.write(json.dumps(track_json,separators=(',',':')))
+        f.close();
+        logger.debug('created json {0}'.format(self.path))
+    def datasource(self):
+        return mapnik.Datasource(type='geojson', file=self.path)
+
+class MemoryTrackOutput:
+    """ Tracks handed to Mapnik in memory as WKB, no files """
+    path = None
+    def __init__(self, tracks, colors, work_folder):
+        self.colors = colors
+        self.wkbs = [ track.get_wkb() for track in tracks ]
+    def datasource(self):
+        context = mapnik.Context()
+        context.push('color')
+        context.push('stroke')
+        ds = mapnik.MemoryDatasource()
+        for i in range(len(self.wkbs)):
+            feature = mapnik.Feature(context, i + 1)
+            feature['color'] = self.colors[i]
+            feature['stroke'] = self.colors[i]
+            feature.geometry = mapnik.Geometry.from_wkb(self.wkbs[i])
+            ds.add_feature(feature)
+        return ds
+
+track_outputs = {'geojson': GeoJSONTrackOutput, 'memory': MemoryTrackOutput}
+
+class TileCache:
+    """ Base map tiles on disk as folder/style/zoom/x/y.png, style is
+        a hash of the style file path and mtime """
+    def __init__(self, folder):
+        self.__folder = folder
+        self.hits = 0
+        self.misses = 0
+    def count(self, hits, misses):
+        """ add hits and misses of a worker process """
+        self.hits += hits
+        self.misses += misses
+    @staticmethod
+    def style():
+        style = os.path.abspath(options['mapnik_style_xml'])
+        return hashlib.sha1(u'{0}|{1}'.format(style,
+            os.path.getmtime(style)).encode('utf-8')).hexdigest()[:12]
+    def get(self, zoom, x, y, render):
+        """ tile PNG data, render(zoom, x, y) is called if there is none """
+        path = os.path.join(self.__folder, self.style(), str(zoom), str(x),
+            '{0}.png'.format(y))
+        if os.path.exists(path):
+            self.hits += 1
+            f=open(path,"rb");
+            tile = f.read()
+            f.close();
+            return tile
+        self.misses += 1
+        tile = render(zoom, x, y)
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                # created by another worker
+                pass
+        tmp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+        f=open(tmp_path,"wb");
+        f.write(tile)
+        f.close();
+        os.rename(tmp_path, path)
+        return tile
+    def disk_usage(self):
+        """ (number of tiles, bytes) """
+        num, size = 0, 0
+        for folder, dirs, files in os.walk(self.__folder):
+            for name in files:
+                if name.endswith('.png'):
+                    num += 1
+                    size += os.path.getsize(os.path.join(folder, name))
+        return num, size
+
+tile_cache = TileCache(options.get('folder_tiles',
+    os.path.join(options['folder_images'], 'tiles')))
+
+def warm_tiles(bbox, zooms):
+    """ render missing base map tiles of bbox (xmin, ymin, xmax, ymax) """
+    rndr = get_renderer('png')
+    if rndr is None:
+        raise GPXRenderFailureException('tiles need python-mapnik')
+    for zoom in zooms:
+        xmin, ymax = mercator_pixels(bbox[0], bbox[1], zoom)
+        xmax, ymin = mercator_pixels(bbox[2], bbox[3], zoom)
+        for x in range(int(xmin) // 256, int(xmax) // 256 + 1):
+            for y in range(int(ymin) // 256, int(ymax) // 256 + 1):
+                tile_cache.get(zoom, x, y, rndr.render_tile)
+        logger.info('tiles warmed for zoom {0}: {1} hits, {2} misses'.format(
+            zoom, tile_cache.hits, tile_cache.misses))
+
+renderer = None
+
+def get_renderer(fmt):
+    """ in-process renderer (created once per process)
+        or None if nik4 should be used """
+    global renderer
+    if options.get('render_engine', 'mapnik') not in ('mapnik', 'tiles'):
+        return None
+    if mapnik is None or (fmt == 'svg' and cairo is None):
+        logger.warning('mapnik python bindings not found, fall back to nik4')
+        return None
+    if renderer is None:
+        renderer = MapnikRenderer(options['mapnik_style_xml'],
+            options.get('mapnik_track_layer', 'track'),
+            options.get('folder_fonts'),
+            int(options.get('mapnik_max_styles', 4)))
+    return renderer
+
+def nik4_draw(json_path,bbox,fmt,zoom,color,width):
+    """ render map with nik4 script, returns image data """
+    image_path = ''.join([os.path.splitext(json_path)[0], '.', fmt])
     cmd_nik4 = [options['cmd_nik4']]
     if 'folder_fonts' in options:
         cmd_nik4 += ['--fonts',options['folder_fonts']]
     cmd_nik4 += ['--vars',]
     cmd_nik4 += ['track_color={}'.format(color)]
     cmd_nik4 += ['track_width={}'.format(width)]
-    cmd_nik4 += [
-        "-b",str(xmin),str(ymin),str(xmax),str(ymax),'-z',str(zoom),
+    cmd_nik4 += ['track_geojson={}'.format(json_path)]
+    cmd_nik4 += ["-b"] + [str(c) for c in bbox]
+    cmd_nik4 += ['-z',str(zoom),
         '-f',fmt,options['mapnik_style_xml'],image_path
         ]
     logger.debug(' '.join(cmd_nik4))
     retcode = subprocess.call(cmd_nik4)
     if retcode != 0:
-        raise GPXNik4FailureException('Nik4 returned nonzero code '.format(retcode))
-    return image_path
+        raise GPXNik4FailureException('Nik4 returned nonzero code {}'.format(retcode))
+    f=open(image_path,"rb");
+    image = f.read()
+    f.close();
+    return image
+
+def gpx_draw(tracks,work_folder,fmt,zoom,colors,width):
+    """ draw tracks over the map in one pass, track i in colors[i],
+        returns (image data, (tile hits, tile misses)) as the counters
+        of a pool worker's tile cache don't reach the bot process """
+    simple_tracks = [ track.simplified(zoom,
+        float(options.get('simplify_pixels', 0.5)),
+        options.get('simplify_algorithm', 'dp')) for track in tracks ]
+    logger.info('tracks simplified from {0} to {1} points'.format(
+        sum(t.get_num_points() for t in tracks),
+        sum(t.get_num_points() for t in simple_tracks)))
+    rndr = get_renderer(fmt)
+    output = options.get('track_output', 'geojson')
+    if rndr is None:
+        # nik4 reads the track from file
+        output = 'geojson'
+    track_output = track_outputs[output](simple_tracks, colors, work_folder)
+    bbox = draw_bbox(tracks)
+    logger.debug('draw bbox {0}'.format(str(bbox)))
+    color = colors[0]
+    if (rndr is not None and fmt == 'png'
+            and options.get('render_engine') == 'tiles'):
+        hits, misses = tile_cache.hits, tile_cache.misses
+        image = rndr.render_composite(track_output,bbox,zoom,color,width,
+            tile_cache)
+        if image is not None:
+            return image, (tile_cache.hits - hits, tile_cache.misses - misses)
+        logger.warning('map style is not in web mercator, cannot use tiles')
+    if rndr is not None:
+        return rndr.render(track_output,bbox,zoom,fmt,color,width), (0, 0)
+    return nik4_draw(track_output.path,bbox,fmt,zoom,color,width), (0, 0)
+
+def union_bbox(bboxes):
+    """ bbox covering all the given ones """
+    return {
+        'xmin': min(b['xmin'] for b in bboxes),
+        'ymin': min(b['ymin'] for b in bboxes),
+        'xmax': max(b['xmax'] for b in bboxes),
+        'ymax': max(b['ymax'] for b in bboxes)
+    }
+
+def draw_bbox(tracks):
+    """ (xmin, ymin, xmax, ymax) of the image, tracks bbox with margins """
+    bbox = union_bbox([ track.get_bbox() for track in tracks ])
+    xmin = bbox['xmin'] - (bbox['xmax'] - bbox['xmin']) * 0.05 
+    ymin = bbox['ymin'] - (bbox['ymax'] - bbox['ymin']) * 0.05 
+    xmax = bbox['xmax'] + (bbox['xmax'] - bbox['xmin']) * 0.05 
+    ymax = bbox['ymax'] + (bbox['ymax'] - bbox['ymin']) * 0.05 
+    return (xmin, ymin, xmax, ymax)
+
+def image_size(bbox, zoom):
+    """ (width, height) in pixels of bbox drawn at zoom """
+    x0, y0 = mercator_pixels(bbox[0], bbox[3], zoom)
+    x1, y1 = mercator_pixels(bbox[2], bbox[1], zoom)
+    return max(1, int(round(x1 - x0))), max(1, int(round(y1 - y0)))
+
+max_zoom = 15
+
+class RenderCostModel:
+    """ Render time estimate by image size, seconds per megapixel are
+        learned from the finished renders (moving average). Small images
+        are skipped, their time is mostly the fixed cost of a render """
+    def __init__(self, seconds_per_mpx, weight=0.2, min_pixels=250000):
+        self.__lock = threading.Lock()
+        self.__weight = weight
+        self.__min_pixels = min_pixels
+        self.seconds_per_mpx = seconds_per_mpx
+    def estimate(self, pixels):
+        return self.seconds_per_mpx * pixels / 1e6
+    def update(self, pixels, seconds):
+        if pixels < self.__min_pixels:
+            return
+        with self.__lock:
+            self.seconds_per_mpx += self.__weight * (
+                seconds * 1e6 / max(pixels, 1) - self.seconds_per_mpx)
+
+render_cost = RenderCostModel(float(options.get('render_seconds_per_mpx', 1.0)))
+
+def plan_render(bbox, zoom):
+    """ (zoom the bbox is drawn at, the estimated render time, True if the
+        zoom was lowered to fit the budget).
+        'auto' zoom is the largest one with the image up to auto_zoom_pixels.
+        Renders over render_max_pixels or render_max_seconds get lower zoom,
+        or RenderBudgetException with render_over_budget = reject """
+    max_pixels = int(options.get('render_max_pixels', 25000000))
+    max_seconds = float(options.get('render_max_seconds', 120))
+    def pixels(z):
+        width, height = image_size(bbox, z)
+        return width * height
+    if zoom == 'auto':
+        target = int(options.get('auto_zoom_pixels', 4000000))
+        zoom = max_zoom
+        while zoom > 1 and pixels(zoom) > target:
+            zoom -= 1
+    requested = zoom
+    while zoom > 1 and (pixels(zoom) > max_pixels
+            or render_cost.estimate(pixels(zoom)) > max_seconds):
+        zoom -= 1
+    if zoom != requested:
+        message = 'zoom {0} is over the budget ({1} px, {2:.0f} s), {3} fits'.format(
+            requested, pixels(requested),
+            render_cost.estimate(pixels(requested)), zoom)
+        if options.get('render_over_budget', 'downscale') == 'reject':
+            raise RenderBudgetException(message, zoom)
+        logger.info(message)
+    return zoom, render_cost.estimate(pixels(zoom)), zoom != requested
+
+def read_track(gpx_path):
+    """ parse gpx file """
+    check_gpx_size(os.path.getsize(gpx_path))
+    reader = GpxReader(int(options.get('gpx_max_points', 1000000)))
+    f=open(gpx_path,"rb");
+    try:
+        return reader.read(f)
+    finally:
+        f.close();
+
+def gpx_stat(track):
+    """ track statistics """
+    return track.calc_statistics(options.get('stats_distance', 'fast'))
+
+def png_chunk(kind, data):
+    chunk = kind + data
+    return (struct.pack('>I', len(data)) + chunk +
+        struct.pack('>I', zlib.crc32(chunk) & 0xffffffff))
+
+def elevation_profile_png(profile, width=600, height=200):
+    """ elevation (from statistics 'profile') against distance as PNG,
+        area under the line is filled, grid lines are at round heights """
+    minele = min(e for d, e in profile)
+    maxele = max(e for d, e in profile)
+    edges = elevation_bands(minele, maxele)
+    bottom, top = edges[0], max(edges[-1], edges[0] + 1)
+    length = profile[-1][0] or 1.0
+    # top row of the filled area in every column
+    tops = list()
+    k = 0
+    for x in range(width):
+        d = length * x / (width - 1)
+        while k < len(profile) - 2 and profile[k + 1][0] < d:
+            k += 1
+        (d0, e0), (d1, e1) = profile[k], profile[min(k + 1, len(profile) - 1)]
+        e = e0 if d1 <= d0 else e0 + (e1 - e0) * min(1.0, (d - d0) / (d1 - d0))
+        tops.append(int(round((height - 1) * (top - e) / (top - bottom))))
+    grid = set(int(round((height - 1) * (top - e) / (top - bottom)))
+        for e in edges)
+    white, gray = b'\xff\xff\xff', b'\xd0\xd0\xd0'
+    line, fill = b'\x20\x50\xa0', b'\xa8\xc8\xf0'
+    rows = list()
+    for y in range(height):
+        background = gray if y in grid else white
+        rows.append(b'\x00' + b''.join([background if y < t else
+            (line if y < t + 2 else fill) for t in tops]))
+    return (b'\x89PNG\r\n\x1a\n' +
+        png_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)) +
+        png_chunk(b'IDAT', zlib.compress(b''.join(rows), 6)) +
+        png_chunk(b'IEND', b''))
+
+def gpx_stat_batch(tracks):
+    """ statistics of every track and the total, time values are summed up
+        only if all tracks have them """
+    method = options.get('stats_distance', 'fast')
+    statistics = [ track.calc_statistics(method) for track in tracks ]
+    total = { 'length': sum(s['length'] for s in statistics) }
+    if all('time' in s for s in statistics):
+        total['time'] = sum(s['time'] for s in statistics)
+        total['movetime'] = sum(s['movetime'] for s in statistics)
+        starts = [ s['starttime'] for s in statistics if 'starttime' in s ]
+        if len(starts) > 0:
+            total['starttime'] = min(starts)
+            total['endtime'] = max(s['endtime'] for s in statistics
+                if 'endtime' in s)
+        maxspeeds = [ s['maxspeed'] for s in statistics if 'maxspeed' in s ]
+        if len(maxspeeds) > 0:
+            total['maxspeed'] = max(maxspeeds)
+        if total['time'] > 0:
+            total['speed'] = total['length'] / total['time']
+        if total['movetime'] > 0:
+            total['movespeed'] = sum(s['movespeed'] * s['movetime']
+                for s in statistics if 'movespeed' in s) / total['movetime']
+    if all('ascent' in s for s in statistics):
+        total['ascent'] = sum(s['ascent'] for s in statistics)
+        total['descent'] = sum(s['descent'] for s in statistics)
+        total['minele'] = min(s['minele'] for s in statistics)
+        total['maxele'] = max(s['maxele'] for s in statistics)
+    return total, statistics
+
+class TrackCache:
+    """ Parsed tracks by BlobCache key, the least recently used are dropped
+        when there are too many points in total """
+    def __init__(self, max_points):
+        self.__max_points = max_points
+        self.__lock = threading.Lock()
+        # key -> track, the most recently used at the end
+        self.__tracks = OrderedDict()
+        self.__num_points = 0
+        self.hits = 0
+        self.misses = 0
+    def peek(self, document):
+        """ parsed track or None, the order of eviction is not changed """
+        with self.__lock:
+            return self.__tracks.get(BlobCache.key(document))
+    def get(self, document, pool):
+        """ parsed track, gpx is downloaded and parsed in the pool if needed """
+        key = BlobCache.key(document)
+        with self.__lock:
+            if key in self.__tracks:
+                self.hits += 1
+                track = self.__tracks.pop(key)
+                self.__tracks[key] = track
+                return track
+            self.misses += 1
+        with blob_cache.open(document) as fl_path:
+            with metrics.timer('drawgpx_stage_seconds', stage='parse'):
+                track = run_in_pool(pool,read_track,fl_path)
+        metrics.observe('drawgpx_track_points', track.get_num_points())
+        with self.__lock:
+            if key not in self.__tracks:
+                self.__tracks[key] = track
+                self.__num_points += track.get_num_points()
+            while (self.__num_points > self.__max_points
+                    and len(self.__tracks) > 1):
+                old_key, old_track = self.__tracks.popitem(last=False)
+                self.__num_points -= old_track.get_num_points()
+        return track
+
+track_cache = TrackCache(int(options.get('track_cache_max_points', 2000000)))
+
+# Admission control
+
+def job_cost(documents, zoom):
+    """ estimated seconds of work for the tracks: parsing of those not
+        parsed yet and the render at zoom (None if nothing is drawn).
+        Until the track is parsed its points are guessed by the file size
+        and the image size by the pixel budgets """
+    tracks = [ track_cache.peek(d) for d in documents ]
+    points = sum((d.file_size or 0) / float(gpx_bytes_per_point)
+        for d, track in zip(documents, tracks) if track is None)
+    cost = points / float(options.get('parse_points_per_second', 40000))
+    if zoom is None:
+        return cost
+    max_seconds = float(options.get('render_max_seconds', 120))
+    if all(track is not None for track in tracks):
+        try:
+            zoom, estimate, lowered = plan_render(draw_bbox(tracks), zoom)
+        except RenderBudgetException:
+            estimate = max_seconds
+    elif zoom == 'auto':
+        estimate = render_cost.estimate(
+            int(options.get('auto_zoom_pixels', 4000000)))
+    else:
+        estimate = render_cost.estimate(
+            int(options.get('render_max_pixels', 25000000)))
+    return cost + min(estimate, max_seconds)
+
+# GPX 1.1 track point with time and elevation
+gpx_bytes_per_point = 100
+
+class TokenBucket:
+    """ Tokens are seconds of work, they come at rate per second
+        up to burst """
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.time()
+    def refill(self, now):
+        self.tokens = min(self.burst,
+            self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    def wait(self, cost):
+        """ seconds until there are cost tokens """
+        return max(0.0, cost - self.tokens) / self.rate
+
+class AdmissionController:
+    """ Jobs take their estimated cost from the bucket of the chat
+        (chat_rate seconds of work per second up to chat_burst) and from the
+        global one filled at global_rate, the work the workers can do.
+        The global bucket goes into debt for the queued work, up to
+        max_wait seconds of waiting; debt / global_rate is the estimated
+        wait of a new job. A job costing more than a bucket holds is let in
+        when the bucket is full (idle) """
+    def __init__(self, chat_rate, chat_burst, global_rate, max_wait):
+        self.__lock = threading.Lock()
+        self.__chat_rate = chat_rate
+        self.__chat_burst = chat_burst
+        self.__chats = dict()
+        self.__global = TokenBucket(global_rate, global_rate)
+        self.__max_debt = max_wait * global_rate
+    def admit(self, chat_id, cost):
+        """ take cost from the buckets, returns estimated wait in seconds """
+        now = time.time()
+        with self.__lock:
+            chat = self.__chats.get(chat_id)
+            if chat is None:
+                chat = TokenBucket(self.__chat_rate, self.__chat_burst)
+                self.__chats[chat_id] = chat
+            chat.refill(now)
+            self.__global.refill(now)
+            if chat.tokens < min(cost, chat.burst):
+                raise RateLimitException('chat {0} is over the budget, job of'
+                    ' {1:.1f} s'.format(chat_id, cost),
+                    chat.wait(min(cost, chat.burst)))
+            if (self.__global.tokens < 0 and
+                    self.__global.tokens - cost < -self.__max_debt):
+                raise OverloadException('{0:.0f} s of work is queued, job of'
+                    ' {1:.1f} s'.format(-self.__global.tokens, cost))
+            chat.tokens -= cost
+            self.__global.tokens -= cost
+            if len(self.__chats) > 1000:
+                self.__forget(now)
+            return max(0.0, -self.__global.tokens) / self.__global.rate
+    def refund(self, chat_id, cost):
+        """ give back the cost of the job which was not queued after all """
+        with self.__lock:
+            if chat_id in self.__chats:
+                chat = self.__chats[chat_id]
+                chat.tokens = min(chat.burst, chat.tokens + cost)
+            self.__global.tokens = min(self.__global.burst,
+                self.__global.tokens + cost)
+    def backlog(self):
+        """ seconds of queued work by the estimates """
+        with self.__lock:
+            self.__global.refill(time.time())
+            return max(0.0, -self.__global.tokens) / self.__global.rate
+    def __forget(self, now):
+        """ drop buckets of idle chats, they are full anyway """
+        for chat_id, chat in self.__chats.items():
+            chat.refill(now)
+            if chat.tokens >= chat.burst:
+                del self.__chats[chat_id]
+
+admission = None
+
+@contextmanager
+def admitted_job(chat_id, documents, fmt, zoom):
+    """ admit the job or raise RateLimitException or OverloadException,
+        yields (fmt, zoom, wait). Under overload a drawing is tried once
+        more as png at auto zoom. The cost is given back if the with block
+        fails, e.g. the job is pending already """
+    if admission is None:
+        yield fmt, zoom, 0.0
+        return
+    result = 'admitted'
+    cost = job_cost(documents, zoom)
+    try:
+        try:
+            wait = admission.admit(chat_id, cost)
+        except OverloadException as e:
+            if zoom is None or (fmt, zoom) == ('png', 'auto'):
+                raise
+            logger.info('job is degraded: {0}'.format(e.message))
+            fmt, zoom, result = 'png', 'auto', 'degraded'
+            cost = job_cost(documents, zoom)
+            wait = admission.admit(chat_id, cost)
+    except RateLimitException:
+        metrics.inc('drawgpx_admission_total', result='limited')
+        raise
+    except OverloadException:
+        metrics.inc('drawgpx_admission_total', result='overloaded')
+        raise
+    metrics.inc('drawgpx_admission_total', result=result)
+    logger.info('job of {0:.1f} s {1}, estimated wait {2:.0f} s'.format(
+        cost, result, wait))
+    try:
+        yield fmt, zoom, wait
+    except Exception:
+        admission.refund(chat_id, cost)
+        raise
+
+def queue_message(position, wait):
+    """ (ahead N, about M min) of the job reply """
+    if wait < 60:
+        return u'(впереди {0})'.format(position)
+    return u'(впереди {0}, ждать около {1:.0f} мин)'.format(position,
+        math.ceil(wait / 60))
+
+# Metrics
+
+class Metrics:
+    """ Counters, gauges and histograms with labels, exported in
+        Prometheus text format. A counter or gauge may be given a function
+        returning the value instead of being updated """
+    def __init__(self):
+        self.__lock = threading.Lock()
+        # name -> (type, help, buckets)
+        self.__metrics = OrderedDict()
+        # name -> labels tuple -> value, function
+        # or [bucket counts, sum, count] for histograms
+        self.__values = dict()
+    def __add(self, name, kind, help_text, buckets=None):
+        with self.__lock:
+            if name not in self.__metrics:
+                self.__metrics[name] = (kind, help_text, buckets)
+                self.__values[name] = OrderedDict()
+    def counter(self, name, help_text, func=None, **labels):
+        self.__add(name, 'counter', help_text)
+        if func is not None:
+            with self.__lock:
+                self.__values[name][tuple(sorted(labels.items()))] = func
+    def gauge(self, name, help_text, func=None, **labels):
+        self.__add(name, 'gauge', help_text)
+        if func is not None:
+            with self.__lock:
+                self.__values[name][tuple(sorted(labels.items()))] = func
+    def histogram(self, name, help_text, buckets):
+        self.__add(name, 'histogram', help_text, sorted(buckets))
+    def inc(self, name, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.__lock:
+            values = self.__values[name]
+            values[key] = values.get(key, 0) + value
+    def set(self, name, value, **labels):
+        with self.__lock:
+            self.__values[name][tuple(sorted(labels.items()))] = value
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        buckets = self.__metrics[name][2]
+        with self.__lock:
+            values = self.__values[name]
+            if key not in values:
+                values[key] = [[0] * len(buckets), 0.0, 0]
+            hist = values[key]
+            for i in range(len(buckets)):
+                if value <= buckets[i]:
+                    hist[0][i] += 1
+            hist[1] += value
+            hist[2] += 1
+    @contextmanager
+    def timer(self, name, **labels):
+        """ observe the duration of the with block """
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - started, **labels)
+    @staticmethod
+    def __labels(labels, extra=()):
+        labels = tuple(labels) + tuple(extra)
+        if len(labels) == 0:
+            return ''
+        return '{' + ','.join('{0}="{1}"'.format(k,
+            str(v).replace('\\', '\\\\').replace('"', '\\"'))
+            for k, v in labels) + '}'
+    def export(self):
+        """ all metrics in Prometheus text format """
+        with self.__lock:
+            metrics = list(self.__metrics.items())
+            values = dict((name, list(v.items()))
+                for name, v in self.__values.items())
+        lines = list()
+        for name, (kind, help_text, buckets) in metrics:
+            lines.append('# HELP {0} {1}'.format(name, help_text))
+            lines.append('# TYPE {0} {1}'.format(name, kind))
+            for labels, value in values[name]:
+                if kind != 'histogram':
+                    if callable(value):
+                        value = value()
+                    lines.append('{0}{1} {2}'.format(name,
+                        self.__labels(labels), repr(float(value))))
+                    continue
+                counts, total, count = value
+                for le, num in zip(buckets, counts):
+                    lines.append('{0}_bucket{1} {2}'.format(name,
+                        self.__labels(labels, (('le', repr(float(le))),)), num))
+                lines.append('{0}_bucket{1} {2}'.format(name,
+                    self.__labels(labels, (('le', '+Inf'),)), count))
+                lines.append('{0}_sum{1} {2}'.format(name,
+                    self.__labels(labels), repr(total)))
+                lines.append('{0}_count{1} {2}'.format(name,
+                    self.__labels(labels), count))
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+metrics.histogram('drawgpx_stage_seconds',
+    'Duration of job stages: download, parse, stat, render, upload',
+    [0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300])
+metrics.histogram('drawgpx_queue_wait_seconds',
+    'Time jobs spend waiting in the queues',
+    [0.01, 0.1, 0.5, 1, 5, 10, 30, 60, 300])
+metrics.histogram('drawgpx_track_points', 'Points of parsed tracks',
+    [100, 1000, 5000, 10000, 50000, 100000, 500000, 1000000])
+metrics.histogram('drawgpx_gpx_bytes', 'Size of GPX files of the jobs',
+    [10 ** 4, 10 ** 5, 10 ** 6, 5 * 10 ** 6, 10 ** 7, 5 * 10 ** 7])
+metrics.counter('drawgpx_errors_total', 'Failed jobs by exception')
+metrics.counter('drawgpx_state_writes_total', 'Writes to the state database')
+metrics.counter('drawgpx_admission_total',
+    'Jobs admitted, degraded, limited by the chat budget or refused by overload')
+metrics.gauge('drawgpx_admission_backlog_seconds',
+    'Estimated wait of a new job',
+    lambda: admission.backlog() if admission is not None else 0)
+metrics.gauge('drawgpx_render_seconds_per_mpx',
+    'Render time estimate learned from the finished renders',
+    lambda: render_cost.seconds_per_mpx)
+for cache_name in ('render', 'tiles', 'tracks'):
+    metrics.counter('drawgpx_cache_hits_total', 'Cache hits',
+        lambda cache_name=cache_name: metrics_cache(cache_name).hits,
+        cache=cache_name)
+    metrics.counter('drawgpx_cache_misses_total', 'Cache misses',
+        lambda cache_name=cache_name: metrics_cache(cache_name).misses,
+        cache=cache_name)
+
+def metrics_cache(name):
+    return {'render': render_cache, 'tiles': tile_cache,
+        'tracks': track_cache}[name]
+
+class MetricsRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ GET /metrics """
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = metrics.export()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    def log_message(self, fmt, *args):
+        logger.debug('metrics: ' + fmt % args)
+
+def start_metrics_server(host, port):
+    """ serve /metrics in a background thread """
+    server = BaseHTTPServer.HTTPServer((host, port), MetricsRequestHandler)
+    th = threading.Thread(target=server.serve_forever, name='metrics')
+    th.daemon = True
+    th.start()
+    logger.info('metrics on http://{0}:{1}/metrics'.format(host, port))
+    return server
+
+# jobs of the current thread are profiled if profiling.prefix is set
+profiling = threading.local()
+
+def profile_call(path_prefix, min_seconds, func, *args):
+    """ run func under cProfile, the stats are saved as
+        path_prefix-pid.prof if it took min_seconds or more """
+    profiler = cProfile.Profile()
+    started = time.time()
+    try:
+        return profiler.runcall(func, *args)
+    finally:
+        elapsed = time.time() - started
+        if elapsed >= min_seconds:
+            path = '{0}-{1}.prof'.format(path_prefix, os.getpid())
+            profiler.dump_stats(path)
+            logger.info('slow call {0:.1f} s profiled to {1}'.format(
+                elapsed, path))
+
+# Persistent state
+
+class StateStore:
+    """ Chat tracks and pending jobs kept in SQLite (WAL mode) to survive
+        restarts. Writes are queued and done by a background thread,
+        a batch per transaction, so the bot never waits for the disk;
+        reads are done once at startup """
+    def __init__(self, path, flush_interval=0.5):
+        self.__path = path
+        self.__flush_interval = flush_interval
+        self.__cond = threading.Condition()
+        self.__writes = []
+        self.__writing = False
+        self.__closed = False
+        db = self.__connect()
+        with db:
+            db.execute('CREATE TABLE IF NOT EXISTS chats '
+                '(chat_id INTEGER PRIMARY KEY, data TEXT)')
+            db.execute('CREATE TABLE IF NOT EXISTS jobs '
+                '(id TEXT PRIMARY KEY, queue TEXT, callback TEXT, '
+                'context TEXT, key TEXT, created REAL)')
+        db.close()
+        self.__thread = threading.Thread(target=self.__writer,
+            name='state-writer')
+        self.__thread.daemon = True
+        self.__thread.start()
+    def __connect(self):
+        db = sqlite3.connect(self.__path, timeout=30)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        return db
+    def __write(self, sql, args):
+        with self.__cond:
+            if self.__closed:
+                return
+            self.__writes.append((sql, args))
+            self.__cond.notify_all()
+    def save_chat(self, chat_id, data):
+        self.__write('INSERT OR REPLACE INTO chats VALUES (?, ?)',
+            (chat_id, json.dumps(data)))
+    def add_job(self, job_id, queue, callback, context, key):
+        self.__write('INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?)',
+            (job_id, queue, callback, json.dumps(context), json.dumps(key),
+            time.time()))
+    def remove_job(self, job_id):
+        self.__write('DELETE FROM jobs WHERE id = ?', (job_id,))
+    def load_chats(self):
+        """ chat_id -> data as saved """
+        db = self.__connect()
+        try:
+            return dict((chat_id, json.loads(data)) for chat_id, data in
+                db.execute('SELECT chat_id, data FROM chats'))
+        finally:
+            db.close()
+    def load_jobs(self):
+        """ (id, queue, callback, context, key) in the order of arrival """
+        db = self.__connect()
+        try:
+            return [(job_id, queue, callback, json.loads(context),
+                json.loads(key)) for job_id, queue, callback, context, key in
+                db.execute('SELECT id, queue, callback, context, key '
+                'FROM jobs ORDER BY created')]
+        finally:
+            db.close()
+    def close(self):
+        """ write what is queued and stop the writer,
+            later writes are ignored """
+        with self.__cond:
+            self.__closed = True
+            self.__cond.notify_all()
+        self.__thread.join()
+    def __writer(self):
+        db = self.__connect()
+        while True:
+            with self.__cond:
+                while len(self.__writes) == 0 and not self.__closed:
+                    self.__cond.wait()
+                if len(self.__writes) == 0:
+                    break
+                # let the batch grow
+                if not self.__closed:
+                    self.__cond.wait(self.__flush_interval)
+                writes, self.__writes = self.__writes, []
+            try:
+                with db:
+                    for sql, args in writes:
+                        db.execute(sql, args)
+                metrics.inc('drawgpx_state_writes_total', len(writes))
+            except sqlite3.Error as e:
+                logger.error('cant save state: {0}'.format(e))
+        db.close()
+
+state_store = None
+
+def encode_state(value):
+    """ JSON-friendly copy of job context or chat data,
+        Telegram documents become dicts """
+    if isinstance(value, telegram.Document):
+        return {'document': value.to_dict()}
+    if isinstance(value, (list, tuple, deque)):
+        return [encode_state(v) for v in value]
+    if isinstance(value, dict):
+        return dict((k, encode_state(v)) for k, v in value.items())
+    return value
+
+def decode_state(value, bot):
+    """ reverse of encode_state, lists come back as tuples """
+    if isinstance(value, list):
+        return tuple(decode_state(v, bot) for v in value)
+    if isinstance(value, dict):
+        if value.keys() == ['document']:
+            return telegram.Document.de_json(value['document'], bot)
+        return dict((k, decode_state(v, bot)) for k, v in value.items())
+    return value
+
+def save_chat_state(chat_id, chat_data):
+    """ persist tracks of the chat (if the state is kept) """
+    if state_store is None:
+        return
+    state_store.save_chat(chat_id, encode_state(dict((name, chat_data[name])
+        for name in ('last gpx', 'gpx list') if name in chat_data)))
+
+def restore_chat_state(bot, all_chat_data):
+    """ fill dispatcher chat_data with the saved tracks """
+    chats = state_store.load_chats()
+    for chat_id, data in chats.items():
+        data = decode_state(data, bot)
+        chat_data = all_chat_data[chat_id]
+        if 'last gpx' in data:
+            chat_data['last gpx'] = data['last gpx']
+        for document in data.get('gpx list', ()):
+            remember_gpx(chat_data, document)
+    return len(chats)
+
+# Scheduler
+
+pools = dict()
+
+def pool_worker_init():
+    """ leave Ctrl-C handling to the main process """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def run_in_pool(name, func, *args):
+    """ call func in the named worker process pool (in place if no pool),
+        it is profiled too if the job is """
+    prefix = getattr(profiling, 'prefix', None)
+    if prefix is not None:
+        args = (prefix + '-' + func.__name__, profiling.min_seconds,
+            func) + args
+        func = profile_call
+    if name not in pools:
+        return func(*args)
+    return pools[name].apply(func, args)
+
+class SchedulerJob:
+    """ Scheduled job, callback is called as callback(bot, job) """
+    def __init__(self, callback, context, key, job_id=None):
+        self.callback = callback
+        self.context = context
+        self.key = key
+        self.queued = time.time()
+        # set if the job is kept in the state store
+        self.id = job_id
+        # number of times the job was forwarded to the next stage
+        self.stage = 0
+
+class JobScheduler:
+    """ Job queues served by their own worker threads,
+        jobs of different chats are taken in turn (round robin).
+        A job may be passed from queue to queue (download, draw, upload),
+        so every stage has its own number of threads.
+        With a state store the jobs of persistent_jobs are saved when put
+        and removed when the last stage is done """
+    def __init__(self, bot, threads, max_pending, store=None):
+        self.__bot = bot
+        self.__max_pending = max_pending
+        self.__store = store
+        self.__cond = threading.Condition()
+        # queue name -> chat_id -> deque of jobs
+        self.__queues = dict((name, OrderedDict()) for name in threads)
+        self.__keys = set()
+        self.__num_pending = 0
+        self.__busy = dict((name, 0) for name in threads)
+        for name, num in threads.items():
+            metrics.gauge('drawgpx_queue_pending', 'Jobs waiting in the queue',
+                lambda name=name: self.pending(name), queue=name)
+            metrics.gauge('drawgpx_workers', 'Worker threads of the queue',
+                lambda num=num: num, queue=name)
+            metrics.gauge('drawgpx_workers_busy', 'Worker threads running a job',
+                lambda name=name: self.__busy[name], queue=name)
+            for i in range(num):
+                th = threading.Thread(target=self.__worker, args=(name,),
+                    name='{0}-worker-{1}'.format(name, i))
+                th.daemon = True
+                th.start()
+    def put(self, name, callback, context, key=None):
+        """ add job to the queue, returns number of jobs waiting
+            in the queue before it """
+        with self.__cond:
+            if key is not None and key in self.__keys:
+                raise DuplicateJobException('job {0} is pending already'.format(key))
+            if self.__num_pending >= self.__max_pending:
+                raise SchedulerFullException('{0} jobs are pending'.format(
+                    self.__num_pending))
+            job = SchedulerJob(callback, context, key)
+            if self.__store is not None and callback.__name__ in persistent_jobs:
+                job.id = uuid.uuid4().hex
+                self.__store.add_job(job.id, name, callback.__name__,
+                    encode_state(context), encode_state(key))
+            return self.__append(name, job)
+    def restore(self, name, callback, context, key, job_id):
+        """ add the job saved before restart, it was admitted already """
+        with self.__cond:
+            if key is not None and key in self.__keys:
+                raise DuplicateJobException('job {0} is pending already'.format(key))
+            return self.__append(name, SchedulerJob(callback, context, key,
+                job_id))
+    def __append(self, name, job):
+        queue = self.__queues[name]
+        position = sum([len(jobs) for jobs in queue.values()])
+        queue.setdefault(job.context['chat_id'], deque()).append(job)
+        if job.key is not None:
+            self.__keys.add(job.key)
+        self.__num_pending += 1
+        self.__cond.notify_all()
+        return position
+    def forward(self, name, callback, job):
+        """ pass the job to the next stage, it was admitted by put already """
+        with self.__cond:
+            job.callback = callback
+            job.stage += 1
+            job.key = None
+            job.queued = time.time()
+            self.__queues[name].setdefault(job.context['chat_id'],
+                deque()).append(job)
+            self.__num_pending += 1
+            self.__cond.notify_all()
+    def pending(self, name):
+        """ number of jobs in the queue """
+        with self.__cond:
+            return sum([len(jobs) for jobs in self.__queues[name].values()])
+    def __take(self, name):
+        """ next job of the first chat in turn, the chat goes to the end """
+        queue = self.__queues[name]
+        while len(queue) == 0:
+            self.__cond.wait()
+        chat_id, jobs = queue.popitem(last=False)
+        job = jobs.popleft()
+        if len(jobs) > 0:
+            queue[chat_id] = jobs
+        if job.key is not None:
+            self.__keys.discard(job.key)
+        self.__num_pending -= 1
+        return job
+    def __worker(self, name):
+        profile_rate = float(options.get('profile_rate', 0))
+        profile_folder = options.get('folder_profiles',
+            os.path.dirname(options['file_log']))
+        while True:
+            with self.__cond:
+                job = self.__take(name)
+                self.__busy[name] += 1
+                stage = job.stage
+            metrics.observe('drawgpx_queue_wait_seconds',
+                time.time() - job.queued, queue=name)
+            try:
+                if profile_rate > 0 and random.random() < profile_rate:
+                    profiling.prefix = os.path.join(profile_folder,
+                        '{0}-{1}'.format(int(time.time() * 1000),
+                        threading.current_thread().name))
+                    profiling.min_seconds = float(options.get(
+                        'profile_min_seconds', 10))
+                    profile_call(profiling.prefix, profiling.min_seconds,
+                        job.callback, self.__bot, job)
+                else:
+                    job.callback(self.__bot, job)
+            except Exception as e:
+                logger.error('{0} job failed: {1}'.format(name, e))
+            finally:
+                profiling.prefix = None
+                with self.__cond:
+                    self.__busy[name] -= 1
+                    done = job.stage == stage
+                if job.id is not None and done:
+                    self.__store.remove_job(job.id)
+
+scheduler = None
 
 # Jobs
 
+def send_cached_image(bot, chat_id, key, fmt, file_name):
+    """ send image from the render cache, returns False if there is none """
+    path, file_id = render_cache.get(key)
+    logger.debug('render cache hits {0} misses {1}'.format(
+        render_cache.hits, render_cache.misses))
+    if path is None:
+        return False
+    if file_id is not None:
+        try:
+            bot.send_document(chat_id,document=file_id,caption=file_name,
+                    timeout=300)
+            logger.info(u'cached image (file_id) sent for {0}'.format(file_name))
+            return True
+        except TelegramError as e:
+            logger.warning('Cant send image by file_id: {}'.format(e))
+            render_cache.forget_file_id(key)
+    f=open(path,"rb");
+    msg = bot.send_document(chat_id,document=f,caption=file_name,
+            filename='track.' + fmt,timeout=300)
+    f.close();
+    render_cache.set_file_id(key,msg.document.file_id)
+    logger.info(u'cached image sent for {0}'.format(file_name))
+    return True
+
+def download_gpx(document):
+    """ download stage of a track """
+    if document.file_size:
+        metrics.observe('drawgpx_gpx_bytes', document.file_size)
+    with metrics.timer('drawgpx_stage_seconds', stage='download'):
+        blob_cache.fetch(document)
+
+def job_failed(bot, job, e):
+    """ log the error of a job stage and tell the chat """
+    name = job.context.get('name', u'')
+    metrics.inc('drawgpx_errors_total', error=e.__class__.__name__)
+    if isinstance(e, TelegramError):
+        logger.error('Telegram request failed: {}'.format(e))
+        text = u'Ничего не вышло. Не могу загрузить трек {0}'
+    elif isinstance(e, GPXParseException):
+        logger.error('Cant parse gpx file: {}'.format(e.message))
+        text = u'Ничего не вышло. Чего-то не то с GPX, трек {0}'
+    elif isinstance(e, GPXTooBigException):
+        logger.error('gpx file is too big: {}'.format(e.message))
+        text = u'Ничего не вышло. Слишком большой трек {0}'
+    elif isinstance(e, RenderBudgetException):
+        logger.warning('render is over the budget: {}'.format(e.message))
+        text = (u'Ничего не вышло. Слишком долго рисовать трек {0},'
+            u' попробуй -zoom ' + str(e.zoom))
+    else:
+        if hasattr(e, 'message'):
+            logger.error('Job failed: {}'.format(e.message))
+        else:
+            logger.error('Job failed: {}'.format(e))
+        text = u'Ничего не вышло. Все сломалось, трек {0}'
+    bot.send_message(job.context['chat_id'],text=text.format(name))
+
 def job_gpx_draw(bot, job):
-    """There will be some mapnik magic here"""
-    file_name = u""
+    """download stage of drawing: the image may be cached already,
+       otherwise the track is downloaded for the draw stage"""
     try:
-        chat_id = job.context['chat_id']
         zoom = job.context['zoom']
         fmt = job.context['format']
         color = job.context['color']
-        width = job.context['width']
-        file_name = job.context['document'].file_name
-        logger.info(u'start job to draw gpx {0} (fmt={1}, zoom={2})'.format(file_name,fmt,zoom))
-        fl = job.context['document'].get_file()
-        fl_path = ''.join([options['folder_gpx'], '/track.gpx'])
-        fl.download(custom_path=fl_path)
-        logger.debug(u'downloaded gpx {0} to {1}'.format(file_name,fl_path))
-        image_path = gpx_draw(fl_path,fmt,zoom,color,width)
-        logger.debug(u'nik4 finished with {0}'.format(file_name))
-        f=open(image_path,"rb");
-        if fmt=='png':
-            #bot.send_photo(chat_id,photo=f,caption=file_name)
-            bot.send_document(chat_id,document=f,caption=file_name,
-                    timeout=300)
-        else:
-            bot.send_document(chat_id,document=f,caption=file_name,
-                    timeout=300)
-        f.close();
-        logger.info(u'image successfuly sent for {0}'.format(file_name))
-    except TelegramError as e:
-        logger.error('Cant upload image file: {}'.format(e))
-        bot.send_message(job.context['chat_id'],text=u'Ничего не вышло. Не могу загрузить' +
-            u' трек {0}'.format(file_name))
-    except GPXParseException as e:
-        logger.error('Cant parse gpx file: {}'.format(e.message))
-        bot.send_message(job.context['chat_id'],text=u'Ничего не вышло. Чего-то не то с GPX,' +
-            u' трек {0}'.format(file_name))
+        document = job.context['document']
+        job.context['name'] = document.file_name
+        logger.info(u'start job to draw gpx {0} (fmt={1}, zoom={2})'.format(
+            document.file_name,fmt,zoom))
+        track_id = getattr(document, 'file_unique_id', None)
+        if track_id is None:
+            with blob_cache.open(document) as fl_path:
+                track_id = file_sha1(fl_path)
+        job.context['track_id'] = track_id
+        job.context['caption'] = document.file_name
+        job.context['tracks'] = [document]
+        job.context['colors'] = [color]
+        track = track_cache.peek(document)
+        if track is not None:
+            # 'auto' zoom depends on the track and the budgets, the image
+            # is cached by the zoom it is drawn at
+            plan_job(job, [track])
+            if render_cache.lookup(job.context['key']):
+                scheduler.forward('upload',job_gpx_upload,job)
+                return
+        download_gpx(document)
+        scheduler.forward('draw',job_gpx_render,job)
     except Exception as e:
-        if hasattr(e, 'message'):
-            logger.error('Cant create image file: {}'.format(e.message))
+        job_failed(bot,job,e)
+
+def plan_job(job, tracks):
+    """ plan the render of the job tracks, sets the render cache key and
+        the caption for the planned zoom, returns (zoom, estimate) """
+    zoom, estimate, lowered = plan_render(draw_bbox(tracks),
+        job.context['zoom'])
+    job.context['key'] = RenderCache.key(job.context['track_id'],
+        job.context['format'],zoom,','.join(job.context['colors']),
+        job.context['width'])
+    title = job.context.setdefault('title', job.context['caption'])
+    if lowered:
+        # ASCII as python-telegram-bot 10 sends captions through str()
+        job.context['caption'] = title + u' (zoom {0})'.format(zoom)
+    else:
+        job.context['caption'] = title
+    return zoom, estimate
+
+def job_gpx_render(bot, job):
+    """draw stage: parse the tracks and render them in the worker pool"""
+    try:
+        documents = job.context['tracks']
+        tracks = [ track_cache.get(d,'draw') for d in documents ]
+        bbox = draw_bbox(tracks)
+        looked_up = job.context.get('key')
+        zoom, estimate = plan_job(job, tracks)
+        if (job.context['key'] != looked_up
+                and render_cache.lookup(job.context['key'])):
+            scheduler.forward('upload',job_gpx_upload,job)
+            return
+        # geojson and image
+        size = sum(d.file_size or 0 for d in documents)
+        started = time.time()
+        with workspaces.workspace(2 * size) as ws:
+            with metrics.timer('drawgpx_stage_seconds', stage='render'):
+                image, tiles = run_in_pool('draw',gpx_draw,tracks,ws.folder,
+                    job.context['format'],zoom,
+                    job.context['colors'],job.context['width'])
+        elapsed = time.time() - started
+        if 'draw' in pools:
+            # the worker process counted them in its own copy of the cache
+            tile_cache.count(*tiles)
+        width, height = image_size(bbox, zoom)
+        render_cost.update(width * height, elapsed)
+        logger.info(u'render of {0} at zoom {1}, {2}x{3} px: estimated {4:.1f} s,'
+            u' took {5:.1f} s'.format(job.context['name'], zoom, width, height,
+            estimate, elapsed))
+        render_cache.put(job.context['key'],image)
+        job.context['image'] = image
+        scheduler.forward('upload',job_gpx_upload,job)
+    except Exception as e:
+        job_failed(bot,job,e)
+
+def job_gpx_upload(bot, job):
+    """upload stage: send the image and the message if any"""
+    try:
+        chat_id = job.context['chat_id']
+        key = job.context['key']
+        fmt = job.context['format']
+        caption = job.context['caption']
+        image = job.context.pop('image', None)
+        if image is None:
+            with metrics.timer('drawgpx_stage_seconds', stage='upload'):
+                sent = send_cached_image(bot,chat_id,key,fmt,caption)
+            if not sent:
+                # evicted from the cache since the download stage
+                scheduler.forward('draw',job_gpx_render,job)
+                return
         else:
-            logger.error('Cant create image file: {}'.format(e))
-        bot.send_message(job.context['chat_id'],text=u'Ничего не вышло. Все сломалось,' +
-            u' трек {0}'.format(file_name))
+            f=io.BytesIO(image)
+            f.name = 'track.' + fmt
+            with metrics.timer('drawgpx_stage_seconds', stage='upload'):
+                msg = bot.send_document(chat_id,document=f,caption=caption,
+                        timeout=300)
+            f.close();
+            render_cache.set_file_id(key,msg.document.file_id)
+            logger.info(u'image successfuly sent for {0}'.format(
+                job.context['name']))
+        if 'message' in job.context:
+            bot.send_message(chat_id,text=job.context['message'])
+    except Exception as e:
+        job_failed(bot,job,e)
+
+def format_statistics(statistics):
+    """ statistics message lines """
+    msg = u""
+    if 'length' in statistics:
+        msg += u"\nдлина: {:.1f} км".format(statistics['length']/1000.0)
+    if 'movespeed' in statistics:
+        msg += u"\nскорость: {:.1f} км/ч".format(statistics['movespeed']*3.6)
+    if 'maxspeed' in statistics:
+        msg += u"\nскорость (макс): {:.1f} км/ч".format(statistics['maxspeed']*3.6)
+    if 'time' in statistics:
+        msg += u"\nвремя: {}".format(timestamp2hhmmss(statistics['time']))
+    if 'movetime' in statistics:
+        msg += u"\nвремя в движении: {}".format(timestamp2hhmmss(statistics['movetime']))
+    if 'starttime' in statistics:
+        msg += u"\nначало: {}".format(datetime.fromtimestamp(statistics['starttime'],tz.gettz()).strftime('%c %Z'))
+    if 'endtime' in statistics:
+        msg += u"\nконец: {}".format(datetime.fromtimestamp(statistics['endtime'],tz.gettz()).strftime('%c %Z'))
+    if 'ascent' in statistics:
+        msg += u"\nнабор высоты: {:.0f} м, сброс: {:.0f} м".format(
+            statistics['ascent'], statistics['descent'])
+        msg += u"\nвысота: {:.0f}-{:.0f} м".format(
+            statistics['minele'], statistics['maxele'])
+    splits = statistics.get('splits', [])
+    if len(splits) > 1:
+        max_splits = int(options.get('stats_max_splits', 20))
+        step = int(math.ceil(len(splits) / float(max_splits)))
+        msg += u"\n\nкаждые {0} км:".format(step)
+        for i in range(0, len(splits), step):
+            msg += u"\n{0:>4} км  {1}".format(min(i + step, len(splits)),
+                timestamp2hhmmss(sum(splits[i:i + step])))
+        best = min(range(len(splits)), key=lambda i: splits[i])
+        msg += u"\nлучший км: {0} ({1})".format(best + 1,
+            timestamp2hhmmss(splits[best]))
+    if 'speedhist' in statistics and statistics.get('time', 0) > 0:
+        msg += u"\n\nвремя по скоростям:"
+        bins = StatisticsEngine.speed_bins
+        for i, seconds in enumerate(statistics['speedhist']):
+            if seconds == 0:
+                continue
+            band = (u"{0}-{1}".format(bins[i], bins[i + 1])
+                if i + 1 < len(bins) else u"{0}+".format(bins[i]))
+            msg += u"\n{0:>6} км/ч  {1} ({2:.0f}%)".format(band,
+                timestamp2hhmmss(seconds), 100 * seconds / statistics['time'])
+    if 'elehist' in statistics and statistics['length'] > 0:
+        msg += u"\n\nрасстояние по высотам:"
+        edges, meters = statistics['elehist']
+        for i in range(len(meters) - 1, -1, -1):
+            if meters[i] == 0:
+                continue
+            msg += u"\n{0:.0f}-{1:.0f} м  {2:.1f} км ({3:.0f}%)".format(
+                edges[i], edges[i + 1], meters[i] / 1000.0,
+                100 * meters[i] / statistics['length'])
+    return msg
 
 def job_gpx_stat(bot, job):
-    """download track and calc statistics like length, speed, ..."""
-    file_name = u""
+    """download stage of statistics"""
+    try:
+        document = job.context['document']
+        job.context['name'] = document.file_name
+        logger.info(u'start job to collect stat on {0}'.format(document.file_name))
+        download_gpx(document)
+        scheduler.forward('stat',job_gpx_stat_calc,job)
+    except Exception as e:
+        job_failed(bot,job,e)
+
+def job_gpx_stat_calc(bot, job):
+    """calc statistics like length, speed, ..."""
     try:
         chat_id = job.context['chat_id']
-        file_name = job.context['document'].file_name
-        logger.info(u'start job to collect stat on {0}'.format(file_name))
-        fl = job.context['document'].get_file()
-        fl_path = ''.join([options['folder_gpx'], '/track.gpx'])
-        fl.download(custom_path=fl_path)
-        logger.debug(u'downloaded gpx {0} to {1}'.format(file_name,fl_path))
-        gpx = Gpx2JSONTarget();
-        parser = etree.XMLParser(target=gpx);
-        f=open(fl_path,"r");
-        etree.parse(f,parser);
-        f.close();
-        statistics = gpx.calc_statistics()
+        file_name = job.context['name']
+        track = track_cache.get(job.context['document'],'stat')
+        with metrics.timer('drawgpx_stage_seconds', stage='stat'):
+            statistics = run_in_pool('stat',gpx_stat,track)
         logger.debug(u'stats collected ({0})'.format(file_name))
         msg  = u"Статистика по {0}\n".format(file_name)
-        if 'length' in statistics:
-            msg += u"\nдлина: {:.1f} км".format(statistics['length']/1000.0)
-        if 'movespeed' in statistics:
-            msg += u"\nскорость: {:.1f} км/ч".format(statistics['movespeed']*3.6)
-        if 'maxspeed' in statistics:
-            msg += u"\nскорость (макс): {:.1f} км/ч".format(statistics['maxspeed']*3.6)
-        if 'time' in statistics:
-            msg += u"\nвремя: {}".format(timestamp2hhmmss(statistics['time']))
-        if 'movetime' in statistics:
-            msg += u"\nвремя в движении: {}".format(timestamp2hhmmss(statistics['movetime']))
-        if 'starttime' in statistics:
-            msg += u"\nначало: {}".format(datetime.fromtimestamp(statistics['starttime'],tz.gettz()).strftime('%c %Z'))
-        if 'endtime' in statistics:
-            msg += u"\nконец: {}".format(datetime.fromtimestamp(statistics['endtime'],tz.gettz()).strftime('%c %Z'))
+        msg += format_statistics(statistics)
         bot.send_message(chat_id,text=msg)
-        bot.send_location(chat_id, disable_notification = True,
-            latitude=gpx.get_multiline()[0][0]['lat'],
-            longitude=gpx.get_multiline()[0][0]['lon'])
+        if option_flag('stats_profile') and 'profile' in statistics:
+            with metrics.timer('drawgpx_stage_seconds', stage='profile'):
+                image = run_in_pool('stat',elevation_profile_png,
+                    statistics['profile'])
+            f = io.BytesIO(image)
+            f.name = 'profile.png'
+            bot.send_photo(chat_id, photo=f, disable_notification=True,
+                caption=u'elevation {0:.0f}-{1:.0f} m'.format(
+                    statistics['minele'], statistics['maxele']))
+        if track.get_num_points() > 0:
+            start_point = track.get_point(0)
+            bot.send_location(chat_id, disable_notification = True,
+                latitude=start_point['lat'],
+                longitude=start_point['lon'])
         logger.info(u'stats successfuly sent for {0}'.format(file_name))
-    except GPXParseException as e:
-        logger.error('Cant parse gpx file: {}'.format(e.message))
-        bot.send_message(job.context['chat_id'],text=u'Ничего не вышло. Чего-то не то с GPX,' +
-            u' трек {0}'.format(file_name))
     except Exception as e:
-        if hasattr(e, 'message'):
-            logger.error('Cant collect stats: {}'.format(e.message))
-        else:
-            logger.error('Cant collect stats: {}'.format(e))
-        bot.send_message(job.context['chat_id'],text=u'Ничего не вышло. Все сломалось,' +
-            u' трек {0}'.format(file_name))
+        job_failed(bot,job,e)
+
+
+batch_colors = ['red','orange','yellow','green','blue','indigo','violet']
+
+def job_gpx_batch(bot, job):
+    """download stage of drawing recent tracks in one image"""
+    try:
+        fmt = job.context['format']
+        zoom = job.context['zoom']
+        documents = job.context['documents']
+        job.context['name'] = u''
+        logger.info(u'start job to draw {0} gpx (fmt={1}, zoom={2})'.format(
+            len(documents),fmt,zoom))
+        colors = [ batch_colors[i % len(batch_colors)]
+            for i in range(len(documents)) ]
+        # colors go by position, so the same tracks in another order
+        # make another image
+        track_ids = [u'{0}:{1}'.format(BlobCache.key(d), color)
+            for d, color in zip(documents, colors)]
+        job.context['track_id'] = '+'.join(track_ids)
+        job.context['caption'] = u'{0} tracks'.format(len(documents))
+        job.context['tracks'] = documents
+        job.context['colors'] = colors
+        threads = ThreadPool(min(len(documents),
+            int(options.get('batch_threads', 4))))
+        try:
+            threads.map(download_gpx, documents)
+        finally:
+            threads.close()
+        scheduler.forward('draw',job_gpx_batch_render,job)
+    except Exception as e:
+        job_failed(bot,job,e)
+
+def job_gpx_batch_render(bot, job):
+    """draw stage of the batch: total statistics and the image"""
+    try:
+        documents = job.context['tracks']
+        # threads only wait for the pool workers parsing the tracks
+        threads = ThreadPool(min(len(documents),
+            int(options.get('batch_threads', 4))))
+        try:
+            tracks = threads.map(lambda d: track_cache.get(d,'draw'),
+                documents)
+        finally:
+            threads.close()
+        with metrics.timer('drawgpx_stage_seconds', stage='stat'):
+            total, statistics = run_in_pool('stat',gpx_stat_batch,tracks)
+        msg  = u"Статистика по {0} трекам\n".format(len(documents))
+        for document, color, stat in zip(documents, job.context['colors'],
+                statistics):
+            msg += u"\n{0} ({1}): {2:.1f} км".format(document.file_name,
+                color, stat['length']/1000.0)
+        msg += u"\n\nВсего:" + format_statistics(total)
+        job.context['message'] = msg
+        job_gpx_render(bot, job)
+    except Exception as e:
+        job_failed(bot,job,e)
+
+def job_gpx_prefetch(bot, job):
+    """download track in advance"""
+    try:
+        download_gpx(job.context['document'])
+    except Exception as e:
+        logger.warning(u'Cant prefetch gpx {0}: {1}'.format(
+            job.context['document'].file_name, e))
+
+# jobs saved in the state store, by name
+persistent_jobs = dict((job.__name__, job) for job in
+    (job_gpx_draw, job_gpx_stat, job_gpx_batch))
+
+def restore_jobs(bot):
+    """ put the saved jobs back to their queues """
+    jobs = state_store.load_jobs()
+    for job_id, queue, callback, context, key in jobs:
+        try:
+            scheduler.restore(queue, persistent_jobs[callback],
+                decode_state(context, bot), decode_state(key, bot), job_id)
+        except (KeyError, DuplicateJobException) as e:
+            logger.warning('saved job {0} dropped: {1}'.format(job_id, e))
+            state_store.remove_job(job_id)
+    return len(jobs)
 
 
 # Command handlers
 
+def zoom_argument(value):
+    """ -zoom value: auto or 1-15 """
+    if value == 'auto':
+        return value
+    zoom = int(value)
+    if zoom < 1 or zoom > max_zoom:
+        raise ValueError('zoom {0} is out of range'.format(value))
+    return zoom
+
 def on_cmd_help(bot, update):
     logging.info(u'cmd /help from {0}'.format(
         update.message.from_user.name))
@@ -362,11 +2517,15 @@ def on_cmd_help(bot, update):
     help_message += '                     последний трек\n'
     help_message += '         опции:\n'
     help_message += '           -format - png|svg\n'
-    help_message += '           -zoom   - зум 1-15\n'
+    help_message += '           -zoom   - зум 1-15 или auto\n'
     help_message += '           -color  - цвет\n'
     help_message += '              red|orange|yellow|green\n'
     help_message += '              blue|indigo|violet\n'
-    help_message += '           -width  - ширина 1-50'
+    help_message += '           -width  - ширина 1-50\n'
+    help_message += '/gpxbatch [<опции>] - нарисовать последние\n'
+    help_message += '                      треки вместе\n'
+    help_message += '         опции: -format, -zoom, -width\n'
+    help_message += '/gpxclear - забыть треки'
     update.message.reply_text(help_message)
 
 def on_cmd_license(bot, update):
@@ -378,7 +2537,11 @@ def on_cmd_license(bot, update):
     update.message.reply_text(lic_message)
 
 
-def on_cmd_gpxdraw(bot, update, args, job_queue, chat_data):
+def rate_limit_message(e):
+    return u'Ты уже много всего попросил, попробуй через {0:.0f} мин'.format(
+        max(1, math.ceil(e.wait / 60)))
+
+def on_cmd_gpxdraw(bot, update, args, chat_data):
     """Add job to draw last GPX track"""
     logging.info(u'cmd /gpxdraw from {0}'.format(
         update.message.from_user.name))
@@ -389,7 +2552,8 @@ def on_cmd_gpxdraw(bot, update, args, job_queue, chat_data):
         parser.add_argument("-format",required=False, 
             choices=['png','svg'], default='png')
         parser.add_argument("-zoom",required=False, 
-            type = int, choices = range(1,16), default=12)
+            type = zoom_argument,
+            default=zoom_argument(options.get('default_zoom', 'auto')))
         parser.add_argument("-color",required=False, 
             choices=['red','orange','yellow','green','blue','indigo','violet'], 
             default=options['track_color'])
@@ -404,26 +2568,111 @@ def on_cmd_gpxdraw(bot, update, args, job_queue, chat_data):
             return
         else:
             logger.info(u'add job to draw {0}'.format(chat_data['last gpx'].file_name))
+            document = chat_data['last gpx']
+            with admitted_job(chat_id,[document],cmd_options.format,
+                    cmd_options.zoom) as (fmt, zoom, wait):
+                position = scheduler.put('download',job_gpx_draw,
+                    context={
+                        'chat_id':chat_id,
+                        'format':fmt,
+                        'zoom':zoom,
+                        'color':cmd_options.color,
+                        'width':cmd_options.width,
+                        'document':document
+                    },
+                    key=('draw',chat_id,document.file_id,fmt,
+                        zoom,cmd_options.color,cmd_options.width)
+                )
+            if (fmt, zoom) != (cmd_options.format, cmd_options.zoom):
+                update.message.reply_text(
+                    u'Сейчас много дел, нарисую попроще: png, зум auto')
             update.message.reply_text(u'Добавил в список дел:'+
-                u' нарисовать {0}'.format(chat_data['last gpx'].file_name))
-            job_queue.run_once(job_gpx_draw,1,
+                u' нарисовать {0} {1}'.format(document.file_name,
+                queue_message(position,wait)))
+
+    except (SchedulerFullException, OverloadException) as e:
+        logger.warning('cant add drawing job: {}'.format(e.message))
+        update.message.reply_text(u'Слишком много дел, попробуй попозже')
+    except RateLimitException as e:
+        logger.info('drawing job is over the budget: {}'.format(e.message))
+        update.message.reply_text(rate_limit_message(e))
+    except DuplicateJobException as e:
+        logger.info('drawing job is pending already: {}'.format(e.message))
+        update.message.reply_text(u'Уже в списке дел, жди')
+    except ArgumentParseError as e:
+        logger.error('cmd args parse error: {}'.format(e.message))
+        update.message.reply_text('Ерунда какая-то. Посмотри /help')
+    except (KeyError, IndexError, ValueError) as e:
+        logger.error('cant add drawing job: {}'.format(e))
+        update.message.reply_text('Ничего не вышло. Мои глубочайшие извинения.')
+        
+
+def on_cmd_gpxbatch(bot, update, args, chat_data):
+    """Add job to draw recent GPX tracks together"""
+    logging.info(u'cmd /gpxbatch from {0}'.format(
+        update.message.from_user.name))
+    logger.debug(u'cmd /gpxbatch, args {0}'.format(str(args)))
+    chat_id = update.message.chat_id
+    try:
+        parser = SilentArgumentParser(add_help=False)
+        parser.add_argument("-format",required=False, 
+            choices=['png','svg'], default='png')
+        parser.add_argument("-zoom",required=False, 
+            type = zoom_argument,
+            default=zoom_argument(options.get('default_zoom', 'auto')))
+        parser.add_argument("-width",required=False, 
+            type = int, choices = range(1,51), default=options['track_width'])
+
+        cmd_options = parser.parse_args(args)
+
+        if not chat_data.get('gpx list'):
+            update.message.reply_text('Не видел никаких треков')
+            return
+        documents = list(chat_data['gpx list'])
+        logger.info(u'add job to draw {0} tracks'.format(len(documents)))
+        with admitted_job(chat_id,documents,cmd_options.format,
+                cmd_options.zoom) as (fmt, zoom, wait):
+            position = scheduler.put('download',job_gpx_batch,
                 context={
                     'chat_id':chat_id,
-                    'format':cmd_options.format,
-                    'zoom':cmd_options.zoom,
-                    'color':cmd_options.color,
+                    'format':fmt,
+                    'zoom':zoom,
                     'width':cmd_options.width,
-                    'document':chat_data['last gpx']
-                }
+                    'documents':documents
+                },
+                key=('batch',chat_id,tuple(d.file_id for d in documents),
+                    fmt,zoom,cmd_options.width)
             )
+        if (fmt, zoom) != (cmd_options.format, cmd_options.zoom):
+            update.message.reply_text(
+                u'Сейчас много дел, нарисую попроще: png, зум auto')
+        update.message.reply_text(u'Добавил в список дел:'+
+            u' нарисовать {0} треков {1}'.format(len(documents),
+            queue_message(position,wait)))
 
+    except (SchedulerFullException, OverloadException) as e:
+        logger.warning('cant add batch job: {}'.format(e.message))
+        update.message.reply_text(u'Слишком много дел, попробуй попозже')
+    except RateLimitException as e:
+        logger.info('batch job is over the budget: {}'.format(e.message))
+        update.message.reply_text(rate_limit_message(e))
+    except DuplicateJobException as e:
+        logger.info('batch job is pending already: {}'.format(e.message))
+        update.message.reply_text(u'Уже в списке дел, жди')
     except ArgumentParseError as e:
         logger.error('cmd args parse error: {}'.format(e.message))
         update.message.reply_text('Ерунда какая-то. Посмотри /help')
     except (KeyError, IndexError, ValueError) as e:
-        logger.error('cant add drawing job: {}'.format(e))
+        logger.error('cant add batch job: {}'.format(e))
         update.message.reply_text('Ничего не вышло. Мои глубочайшие извинения.')
-        
+
+def on_cmd_gpxclear(bot, update, chat_data):
+    logging.info(u'cmd /gpxclear from {0}'.format(
+        update.message.from_user.name))
+    chat_data.pop('gpx list', None)
+    chat_data.pop('last gpx', None)
+    save_chat_state(update.message.chat_id, chat_data)
+    update.message.reply_text(u'Забыл все треки')
 
 def on_cmd_gpxname(bot, update, chat_data):
     logging.info(u'cmd /gpxname from {0}'.format(
@@ -440,7 +2689,7 @@ def on_cmd_gpxname(bot, update, chat_data):
         else:
             logger.error('Cant process gpxname cmd: {}'.format(e))
 
-def on_cmd_gpxstat(bot, update, job_queue, chat_data):
+def on_cmd_gpxstat(bot, update, chat_data):
     """Add job to collect last GPX track statistics"""
     logging.info(u'cmd /gpxstat from {0}'.format(
         update.message.from_user.name))
@@ -451,15 +2700,28 @@ def on_cmd_gpxstat(bot, update, job_queue, chat_data):
             return
         else:
             logger.info(u'add job to collect stats on {0}'.format(chat_data['last gpx'].file_name))
+            document = chat_data['last gpx']
+            with admitted_job(chat_id,[document],None,None) as (fmt, zoom, wait):
+                position = scheduler.put('download',job_gpx_stat,
+                    context={
+                        'chat_id':chat_id,
+                        'document':document
+                    },
+                    key=('stat',chat_id,document.file_id)
+                )
             update.message.reply_text(u'Добавил в список дел:'+
-                u' статистика по  {0}'.format(chat_data['last gpx'].file_name))
-            job_queue.run_once(job_gpx_stat,1,
-                context={
-                    'chat_id':chat_id,
-                    'document':chat_data['last gpx']
-                }
-            )
+                u' статистика по  {0} {1}'.format(document.file_name,
+                queue_message(position,wait)))
 
+    except (SchedulerFullException, OverloadException) as e:
+        logger.warning('cant add stats job: {}'.format(e.message))
+        update.message.reply_text(u'Слишком много дел, попробуй попозже')
+    except RateLimitException as e:
+        logger.info('stats job is over the budget: {}'.format(e.message))
+        update.message.reply_text(rate_limit_message(e))
+    except DuplicateJobException as e:
+        logger.info('stats job is pending already: {}'.format(e.message))
+        update.message.reply_text(u'Уже в списке дел, жди')
     except (KeyError, IndexError, ValueError) as e:
         logger.error('cant add drawing job: {}'.format(e))
         update.message.reply_text('Ничего не вышло. Мои глубочайшие извинения.')
@@ -470,11 +2732,35 @@ def on_cmd_unknown(bot, update):
 
 # Message handlers
 
+def remember_gpx(chat_data, document):
+    """ keep recent tracks of the chat for /gpxbatch """
+    max_tracks = int(options.get('chat_max_tracks', 10))
+    if 'gpx list' not in chat_data or chat_data['gpx list'].maxlen != max_tracks:
+        chat_data['gpx list'] = deque(chat_data.get('gpx list', ()),
+            maxlen=max_tracks)
+    gpx_list = chat_data['gpx list']
+    for d in list(gpx_list):
+        if BlobCache.key(d) == BlobCache.key(document):
+            gpx_list.remove(d)
+    gpx_list.append(document)
+
 def on_document(bot, update, chat_data):
     logging.debug(u'document {0}'.format(update.message.document.file_name))
     if re.match('.*\.gpx$',update.message.document.file_name,re.I) != None:
         update.message.reply_text(u'Нашел трек: {0}'.format(update.message.document.file_name))
         chat_data['last gpx'] = update.message.document
+        remember_gpx(chat_data, update.message.document)
+        save_chat_state(update.message.chat_id, chat_data)
+        if option_flag('prefetch_gpx'):
+            try:
+                scheduler.put('download',job_gpx_prefetch,
+                    context={
+                        'chat_id':update.message.chat_id,
+                        'document':update.message.document
+                    },
+                    key=('prefetch',update.message.document.file_id))
+            except (SchedulerFullException, DuplicateJobException) as e:
+                logger.info('gpx is not prefetched: {}'.format(e.message))
         logger.info(u'document {0} from {1}'.format(
             update.message.document.file_name,
             update.message.from_user.name))
@@ -487,28 +2773,96 @@ def error(bot, update, error):
 
 def main():
     """Run bot. RUUUUN!!!!"""
+    global scheduler, state_store, admission
+    arg_parser = argparse.ArgumentParser(description='Draw GPX Telegram bot')
+    arg_parser.add_argument('--warm-tiles', nargs=4, type=float,
+        metavar=('XMIN','YMIN','XMAX','YMAX'),
+        help='render base map tiles of the bbox and exit')
+    arg_parser.add_argument('--zoom', default='10-15',
+        help='zoom range for --warm-tiles, e.g. 10-15')
+    cmd_args = arg_parser.parse_args()
+    if cmd_args.warm_tiles is not None:
+        zooms = [int(z) for z in cmd_args.zoom.split('-')]
+        try:
+            warm_tiles(cmd_args.warm_tiles, range(zooms[0], zooms[-1] + 1))
+        except GPXRenderFailureException as e:
+            print('Cant render tiles: {0}'.format(e.message))
+            return
+        num, size = tile_cache.disk_usage()
+        print('{0} tiles rendered, {1} were cached; {2} tiles, {3:.1f} MB in cache'.format(
+            tile_cache.misses, tile_cache.hits, num, size / 1024.0 / 1024.0))
+        return
+
     logger.info("Release the bot!")
     logger.debug('options: {}'.format(options))
+    if options.get('render_engine') == 'tiles':
+        num, size = tile_cache.disk_usage()
+        logger.info('tile cache: {0} tiles, {1} bytes'.format(num, size))
 
-    updater = Updater(token=options['token'])
+    # worker processes are forked before any other thread is started
+    workers_stat = int(options.get('workers_stat', 1))
+    workers_draw = int(options.get('workers_draw', 2))
+    pools['stat'] = multiprocessing.Pool(workers_stat, pool_worker_init)
+    pools['draw'] = multiprocessing.Pool(workers_draw, pool_worker_init)
+    threads = {
+        'download': int(options.get('threads_download', 4)),
+        'stat': workers_stat,
+        'draw': workers_draw,
+        'upload': int(options.get('threads_upload', 4))
+    }
+
+    # connections for the dispatcher and updater threads (as by default)
+    # and for every scheduler thread. api_url points the bot at another
+    # Bot API server, e.g. the stand-in of drawgpxbench.py loadtest
+    bot = Bot(options['token'], base_url=options.get('api_url'),
+        base_file_url=options.get('api_file_url'),
+        request=Request(con_pool_size=8 + sum(threads.values())))
+    updater = Updater(bot=bot)
+
+    if 'state_db' in options:
+        state_store = StateStore(options['state_db'],
+            float(options.get('state_flush_seconds', 0.5)))
+    scheduler = JobScheduler(updater.bot, threads,
+        int(options.get('queue_max_pending', 20)), state_store)
+    if option_flag('admission', True):
+        # a chat may queue admission_chat_burst seconds of work at once and
+        # admission_chat_rate seconds of work per minute after that
+        admission = AdmissionController(
+            float(options.get('admission_chat_rate', 30)) / 60,
+            float(options.get('admission_chat_burst', 120)),
+            float(options.get('admission_global_rate', workers_draw)),
+            float(options.get('admission_max_wait', 600)))
+    if 'metrics_port' in options:
+        start_metrics_server(options.get('metrics_listen', '127.0.0.1'),
+            int(options['metrics_port']))
            
 
     # Get the dispatcher to register handlers
     dp = updater.dispatcher
 
+    if state_store is not None:
+        started = time.time()
+        num_chats = restore_chat_state(updater.bot, dp.chat_data)
+        num_jobs = restore_jobs(updater.bot)
+        logger.info('state restored in {0:.2f} s: {1} chats, {2} jobs'.format(
+            time.time() - started, num_chats, num_jobs))
+
     # on different commands - answer in Telegram
     dp.add_handler(CommandHandler("help", on_cmd_help))
     dp.add_handler(CommandHandler("license", on_cmd_license))
     dp.add_handler(CommandHandler("start", on_cmd_help))
     dp.add_handler(CommandHandler("gpxdraw", on_cmd_gpxdraw,
                                   pass_args=True,
-                                  pass_job_queue=True,
                                   pass_chat_data=True))
     dp.add_handler(CommandHandler("gpxstat", on_cmd_gpxstat,
-                                  pass_job_queue=True,
                                   pass_chat_data=True))
     dp.add_handler(CommandHandler("gpxname", on_cmd_gpxname,
                                   pass_chat_data=True))
+    dp.add_handler(CommandHandler("gpxbatch", on_cmd_gpxbatch,
+                                  pass_args=True,
+                                  pass_chat_data=True))
+    dp.add_handler(CommandHandler("gpxclear", on_cmd_gpxclear,
+                                  pass_chat_data=True))
 
      # log all errors
     dp.add_error_handler(error)
@@ -521,13 +2875,35 @@ def main():
     dp.add_handler(MessageHandler(Filters.command,on_cmd_unknown))
 
     # Start the Bot
-    updater.start_polling(clean=True)
+    if 'webhook_url' in options:
+        # plain HTTP on webhook_listen:webhook_port, TLS is left to the
+        # reverse proxy serving webhook_url unless webhook_cert is given
+        use_tls = 'webhook_cert' in options and 'webhook_key' in options
+        updater.start_webhook(listen=options.get('webhook_listen', '127.0.0.1'),
+            port=int(options.get('webhook_port', 8443)),
+            url_path=options.get('webhook_path', ''),
+            cert=options.get('webhook_cert'),
+            key=options.get('webhook_key'),
+            clean=use_tls,
+            webhook_url=options['webhook_url'])
+        if not use_tls:
+            # the updater registers the webhook only if it does TLS itself
+            updater.bot.set_webhook(url=options['webhook_url'])
+        logger.info('webhook {0}'.format(options['webhook_url']))
+    else:
+        updater.start_polling(clean=True)
 
     # Block until you press Ctrl-C or the process receives SIGINT, SIGTERM or
     # SIGABRT. This should be used most of the time, since start_polling() is
     # non-blocking and will stop the bot gracefully.
     updater.idle()
 
+    # jobs cut short by the exit stay saved and are done after restart
+    if state_store is not None:
+        state_store.close()
+    for pool in pools.values():
+        pool.terminate()
+
     logger.info("I am out")
 
 if __name__ == '__main__':